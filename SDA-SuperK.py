@@ -7,9 +7,6 @@ from pyvisa.constants import StopBits, Parity
 import logging
 from scipy import *
 import numpy as np
-from binascii import unhexlify
-# import crc16 as crc16;
-from crccheck.crc import CrcXmodem
 import time
 import matplotlib.pyplot as plt
 # import statsmodels.api as sm
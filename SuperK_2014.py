@@ -15,18 +15,25 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 # from lib.dll_support import superk_aotf
 import os
+import collections
+import threading
 from re import L
 from Instruments.instrument import Instrument
 import pyvisa
 # import visa
 import Instruments.lib.visa as visa
+import Instruments.lib.superk_telegram as telegram
+from Instruments.lib.crc import crc_xmodem
+from Instruments.lib.framereader import FrameReader
+from Instruments.lib.superk_registers import RegisterShadow
+from Instruments.lib.superk_snapshot import RegisterSnapshot
+from Instruments.lib.asynctransport import AsyncTransport
+from Instruments.lib.superk_sweep import SweepPlan, SweepPoint
+import Instruments.lib.superk_calibration as calibration
 from pyvisa.constants import StopBits, Parity
 import logging
 from scipy import *
 import numpy as np
-from binascii import unhexlify
-# import crc16 as crc16;
-from crccheck.crc import CrcXmodem
 import time
 import matplotlib.pyplot as plt
 # import statsmodels.api as sm
@@ -50,12 +57,46 @@ class SuperK_2014(Instrument):
     _eot = '0A';  # End of telegram - \n
     _soe = '5E';  # Start of substitution word
     _addVal = 64;  # Value to add for substitution
+    _host_id = int(_host_address, 16)
+
+    # Per output: Select output switch value, Select crystal parameter
+    # registers (copied to RF 0x34-0x37, 0x39) and power table register
+    _output_registers = {'VIS/NIR': ('00', ('90', '91', '92', '93', '94'), '95'),
+                         'NIR/IR': ('01', ('A0', 'A1', 'A2', 'A3', 'A4'), 'A5')}
+
+    # (module, register) restore_registers writes, in this order: Select
+    # output switch, RF crystal parameters, wavelengths and powers. Other
+    # registers are read-only, measurements or power table data.
+    _restore_order = tuple([(0x10, 0x34)] +
+                           [(0x06, r) for r in range(0x34, 0x3A)] +
+                           [(0x06, r) for r in range(0x90, 0x98)] +
+                           [(0x06, r) for r in range(0xB0, 0xB8)])
+    # Emission of RF and Select, only restored on request, after the above
+    _emission_registers = ((0x06, 0x30), (0x10, 0x30))
+
+    # Wavelength range (nm) of each output
+    _wavelength_ranges = {'VIS/NIR': (640, 1100), 'NIR/IR': (1155, 2000)}
+
+    # Maximum number of telegrams sent back to back before reading answers
+    _pipeline_depth = 16
+
+    # Registers kept in the write-through shadow: RF wavelengths (0x90-0x97),
+    # powers (0xB0-0xB7) and crystal parameters (0x34-0x39), Select output
+    # (0x34). Emission (0x30) is left out since interlocks change it.
+    _shadow_registers = {0x06: list(range(0x90, 0x98)) + list(range(0xB0, 0xB8)) + list(range(0x34, 0x3A)),
+                         0x10: [0x34]}
 
     def __init__(self, name, address, address_Supk_ext=None, reset=False):
         Instrument.__init__(self, name)  # , tags=['physical']
 
         self._address = address
         self._testvar = 0
+        self._shadow = RegisterShadow(self._shadow_registers)
+        self._absent_registers = set()
+        # Serialises bus access between synchronous callers and the
+        # asyncio transport; held for a whole operation by the latter
+        self._io_lock = threading.RLock()
+        self._transport = AsyncTransport(name + ' transport', self._io_lock)
         # self._visa = visa.instrument(self._address, baud_rate=115200, data_bits=8, stop_bits=1, term_chars='\n')
         rm = pyvisa.ResourceManager()
         try:
@@ -67,6 +108,8 @@ class SuperK_2014(Instrument):
         self._visa_aotf.stop_bits = StopBits.one
         self._visa_aotf.write_termination = '\n'
         self._visa_aotf.read_termination = '\n'
+        # Shortest telegram is SOT, 4 header bytes, 2 CRC bytes and EOT
+        self._aotf_reader = FrameReader(self._visa_aotf, b'\n', min_frame=8)
 
         dirname = 'C:/ROIC-SW/testsystem-sw/GRACE_software/python/Configuration/Supk_extreme/'
         # filename = 'Supk_extreme_callibration_dot_2mmVis_3mmIr_vis.txt'
@@ -83,16 +126,19 @@ class SuperK_2014(Instrument):
         self.calibration_area_vis = cal_area_vis
         self.vis_calibration_file = dirname + filename_vis
 
+        self._load_calibration_tables()
+
         if address_Supk_ext != None:
             self._address_Supk_ext = address_Supk_ext
             self._visa_SuperK = rm.open_resource(self._address_Supk_ext)
+            self._supk_ext_reader = FrameReader(self._visa_SuperK, b'\n')
             # visa.instrument(self._address_compact,
             #         baud_rate=115200, data_bits=8, stop_bits=1)
 
         self.add_parameter('power',
                            flags=Instrument.FLAG_GETSET,
                            type=float, minval=0, maxval=100,
-                           units='%')
+                           units='%', max_age=0.5)
 
         self.add_parameter('power_density',
                            flags=Instrument.FLAG_SET | Instrument.FLAG_SOFTGET,
@@ -106,7 +152,7 @@ class SuperK_2014(Instrument):
         self.add_parameter('wavelength',
                            flags=Instrument.FLAG_GETSET,
                            type=float, minval=640, maxval=2000,
-                           units='nm')
+                           units='nm', max_age=0.5)
 
         self.add_parameter('n_wavel',  # I suppose this is supposed to be mixing several WL to increase power.
                            flags=Instrument.FLAG_SET | Instrument.FLAG_SOFTGET,
@@ -120,7 +166,8 @@ class SuperK_2014(Instrument):
 
         self.add_parameter('output',
                            flags=Instrument.FLAG_GETSET,
-                           type=str, option_list=('VIS/NIR', 'NIR/IR'))
+                           type=str, option_list=('VIS/NIR', 'NIR/IR'),
+                           max_age=0.5)
 
         self.add_parameter('state',
                            flags=Instrument.FLAG_GETSET,
@@ -144,10 +191,17 @@ class SuperK_2014(Instrument):
         self.add_function('ask_supk_ext');
         self.add_function('update_power_table');
         self.add_function("set_power_for_n_wavel")
+        self.add_function('read_all_registers');
         self.add_function('write_all_registers');
         self.add_function('get_power_calibration');
         self.add_function('get_power_calibration_inv');
+        self.add_function('get_power_calibration_many');
+        self.add_function('get_power_calibration_inv_many');
         self.add_function('update');
+        self.add_function('resync');
+        self.add_function('compile_sweep');
+        self.add_function('run_sweep');
+        self.add_function('acquire_calibration');
 
         # Default values
         self.set_n_wavel(1);
@@ -164,121 +218,347 @@ class SuperK_2014(Instrument):
         self.get_all();
 
     def get_all(self):
-        self.get_power();
-        self.get_wavelength()
-        self.get_output();
-        self.get_state();
+        # Read everything from the device, not from recently stored values
+        self.invalidate_cache()
+        self.get(['power', 'wavelength', 'output', 'state']);
         # self.get_shutter();
 
+    def resync(self):
+        '''
+        Read output, state, power and wavelength and the shadowed registers
+        back from the device. Between resyncs the driver works from the
+        values it last wrote or read, see _known_value.
+        '''
+        self.get_all();
+        self.resync_registers();
+
+    def _known_value(self, name):
+        '''
+        Return the value of parameter 'name' as last set or read by the
+        driver. The device is only queried if the value is not known yet.
+        '''
+        value = self._get_value(name, query=False)
+        if value is None:
+            value = self._get_value(name)
+        return value
+
     def ask_AOTF(self, command):
         '''
         Write a command and read value from the device
         '''
+        return self._ask_raw(command).hex()
+
+    def _ask_raw(self, command, accept=None):
+        '''
+        Write a telegram and return the raw answer (bytes) up to and
+        including the end of telegram byte. If given, accept(answer)
+        tells whether an answer belongs to the telegram; answers that do
+        not, e.g. late answers to an earlier exchange, are skipped.
+        '''
         try:
-            # result = self._visa_aotf.query(command)
-            self._visa_aotf.write_raw(command)
-            a = b'00'
-            result = ''
-            while a != b'\n':
-                a = (self._visa_aotf.read_bytes(1))
-                result = result + a.hex()
+            with self._io_lock:
+                result = self._aotf_reader.query(command)
+                skipped = 0
+                while accept is not None and not accept(result):
+                    skipped += 1
+                    if skipped > self._pipeline_depth:
+                        self._aotf_reader.flush()
+                        result = b''
+                        break
+                    result = self._aotf_reader.read_frame()
         except Exception as e:
             print('VisaIOError: ' + str(e))
-            result = ''
+            with self._io_lock:
+                self._aotf_reader.flush()
+            result = b''
+        self._report_bus(len(command), len(result))
         return result
 
+    def _ask_raw_many(self, command, count):
+        '''
+        Write several telegrams at once and return the raw answers read.
+        '''
+        with self._io_lock:
+            answers = self._aotf_reader.exchange(command, count)
+            if len(answers) < count:
+                # Do not leave late answers for the next exchange
+                self._aotf_reader.flush()
+        self._report_bus(len(command), sum(len(answer) for answer in answers))
+        return answers
+
+    async def send_command_async(self, dest_add, type_in, register_in, data_in):
+        '''
+        send_command for asyncio code. Requests are queued on the driver's
+        transport and executed on its worker thread.
+        '''
+        return await self._transport.submit(self.send_command, dest_add, type_in, register_in, data_in)
+
+    async def set_wavelength_async(self, value):
+        '''
+        set_wavelength for asyncio code, e.g.
+        await asyncio.gather(superk.set_wavelength_async(1200), analyzer_task)
+        '''
+        return await self._transport.submit(self.set_wavelength, value)
+
+    async def set_power_async(self, value):
+        '''
+        set_power for asyncio code.
+        '''
+        return await self._transport.submit(self.set_power, value)
+
+    async def set_state_async(self, value):
+        '''
+        set_state for asyncio code.
+        '''
+        return await self._transport.submit(self.set_state, value)
+
+    async def set_output_async(self, value):
+        '''
+        set_output for asyncio code.
+        '''
+        return await self._transport.submit(self.set_output, value)
+
+    def remove(self):
+        self._transport.close()
+        Instrument.remove(self)
+
     def ask_supk_ext(self, command):
         '''
         Write a command and read value from the device (SuperK Compact)
         '''
         try:
-            # result = self._visa_SuperK.query(command)
-            self._visa_SuperK.write_raw(command)
-            a = b'00'
-            result = ''
-            while a != b'\n':
-                a = (self._visa_aotf.read_bytes(1))
-                result = result + a.hex()
+            answer = self._supk_ext_reader.query(command)
         except Exception as e:
             print('VisaIOError: ' + str(e))
-            result = ''
-        return result
+            answer = b''
+        self._report_bus(len(command), len(answer))
+        return answer.hex()
+
+    def is_busy(self):
+        '''
+        Return whether the bus is in use, by another thread or by queued
+        asynchronous requests, so background probes should wait.
+        '''
+        if self._transport.pending():
+            return True
+        if not self._io_lock.acquire(False):
+            return True
+        self._io_lock.release()
+        return False
+
+    def get_io_stats(self):
+        '''
+        Return visa call count and duration (us) of the last telegram,
+        and the totals since the driver was created.
+        '''
+        stats = self._aotf_reader.last_stats
+        return {'visa_calls': stats.visa_calls,
+                'duration_us': stats.duration_us,
+                'total_visa_calls': self._aotf_reader.total_calls,
+                'total_telegrams': self._aotf_reader.total_frames}
+
+    def send_telegram(self, dest, type, register, data=b'', debug=False):
+        '''
+        Send a telegram to a module and return the decoded answer.
+
+        Input:
+            dest, type, register (int): destination address, telegram type
+                and register
+            data (bytes): payload, LSB first
+        Output: Telegram, or None if no valid answer was received
+        '''
+        frame = telegram.encode(dest, self._host_id, type, register, data)
+
+        def accept(answer):
+            try:
+                reply = telegram.decode(answer)
+            except telegram.TelegramError:
+                return True
+            if not reply.crc_ok or telegram.is_answer(reply, self._host_id, dest, type, register):
+                return True
+            print('Skipping answer telegram not matching the request: ' + reply.hex())
+            return False
+
+        answer = self._ask_raw(frame, accept)
+        try:
+            reply = telegram.decode(answer)
+        except telegram.TelegramError as e:
+            print('Invalid answer telegram from {}: {}'.format(dest, e))
+            reply = None
+        else:
+            if not reply.crc_ok:
+                print("CRC ERROR in receiving answer telegram from {}".format(dest))
+                print(f"Send message: {frame.hex()}")
+                print(f"Recived message: {answer.hex()}")
+        self._track_register(dest, type, register, data, reply)
+        if reply is None:
+            return None
+        if debug:
+            print("HW exchange:")
+            print(frame.hex())
+            print(answer.hex())
+            print(reply.hex())
+            print('{} visa calls, {:.0f} us'.format(*self._aotf_reader.last_stats))
+        return reply
 
     def send_command(self, dest_add, type_in, register_in, data_in, debug=False):
         '''
         Send a command to RF module
         type_in, register_in and data_in are give in HEX string format (without 0x)
         '''
-        data_in_end = '';
-        data_in_end_crc = '';
-        if data_in != "":  # data is little endian! which means LSB first this flips the order:
-            for i in reversed(range(0, len(data_in), 2)):
-                if data_in[i:i + 2] == self._sot or data_in[i:i + 2] == self._eot or data_in[
-                                                                                     i:i + 2] == self._soe or data_in[
-                                                                                                              i:i + 2] == self._sot.lower() or data_in[
-                                                                                                                                               i:i + 2] == self._eot.lower() or data_in[
-                                                                                                                                                                                i:i + 2] == self._soe.lower():
-                    data_in_end += self._soe + hex(int(data_in[i:i + 2], 16) + self._addVal)[2:];  # fix reserved bytes
-                else:
-                    data_in_end += data_in[i:i + 2];
-                data_in_end_crc += data_in[i:i + 2];
-        crc = self.calculate_crc(dest_add + self._host_address + type_in + register_in + data_in_end_crc);  # calc CRC
-        if crc[2:4] == self._sot or crc[2:4] == self._eot or crc[2:4] == self._soe or crc[
-                                                                                      2:4] == self._sot.lower() or crc[
-                                                                                                                   2:4] == self._eot.lower() or crc[
-                                                                                                                                                2:4] == self._soe.lower():
-            crc = crc[0:2] + (self._soe + hex(int(crc[2:4], 16) + self._addVal)[2:]) + crc[
-                                                                                       4:];  # fix reserved bytes for CRC
-        elif crc[4:] == self._sot or crc[4:] == self._eot or crc[4:] == self._soe or crc[
-                                                                                     4:] == self._sot.lower() or crc[
-                                                                                                                 4:] == self._eot.lower() or crc[
-                                                                                                                                             4:] == self._soe.lower():
-            crc = crc[0:4] + (self._soe + hex(int(crc[4:], 16) + self._addVal)[2:])
-        message = dest_add + self._host_address + type_in + register_in + data_in_end
-        message_full = self._sot + message + crc[2:] + self._eot
-        answer = self.ask_AOTF(bytes.fromhex(message_full))
-
-        # Decode response
-        answer_hex = answer
-        answer_hex_filtered = ''
-        SpecialChar = 0
-
-        for i in range(0, len(answer_hex), 2):
-            if answer_hex[i:i + 2] == self._sot.lower():
-                # start of telegram
-                continue
+        # data is little endian! which means LSB first this flips the order:
+        reply = self.send_telegram(int(dest_add, 16), int(type_in, 16),
+                                   int(register_in, 16), bytes.fromhex(data_in)[::-1], debug=debug);
+        if reply is None:
+            return '';
+        # Answer is structured like this: address, host, type, register, data (MSB first), CRC
+        return reply.hex();
+
+    def _track_register(self, dest, type, register, data, reply):
+        '''
+        Keep the register shadow in line with a telegram exchange.
+        '''
+        if not self._shadow.covers(dest, register):
+            return
+        ok = reply is not None and reply.crc_ok and reply.register == register
+        if type == telegram.TYPE_WRITE:
+            if ok and reply.type == telegram.TYPE_ACK:
+                self._shadow.update(dest, register, data)
+            else:
+                self._shadow.discard(dest, register)
+        elif type == telegram.TYPE_READ:
+            if ok and reply.type == telegram.TYPE_DATAGRAM:
+                self._shadow.update(dest, register, reply.data)
+
+    def _skip_write(self, dest, register, data, force=False):
+        '''
+        Return whether a write can be skipped because the shadow shows the
+        register already holds data, and count it.
+        '''
+        if not self._shadow.covers(dest, register):
+            return False
+        if not force and self._shadow.is_current(dest, register, data):
+            self._shadow.skipped += 1
+            return True
+        self._shadow.sent += 1
+        return False
+
+    def write_register(self, dest_add, register_in, data_in, force=False):
+        '''
+        Write a register unless the shadow shows it already holds data_in.
+        Arguments are hex strings as for send_command.
+
+        Output: answer as returned by send_command, or None if the write
+            was skipped
+        '''
+        if self._skip_write(int(dest_add, 16), int(register_in, 16),
+                            bytes.fromhex(data_in)[::-1], force):
+            return None
+        return self.send_command(dest_add, '05', register_in, data_in)
 
-            elif answer_hex[i:i + 2] == self._eot.lower():
-                # end of telegram and check CRC
-                crc = CrcXmodem.calc(unhexlify(answer_hex_filtered))
-                if (crc != 0):
-                    print("CRC ERROR in receiving answer telegram from {}".format(dest_add))
-                    print(f"Send message: {message_full}")
-                    print(f"Recived message: {answer}")
+    def send_telegrams(self, requests):
+        '''
+        Send several telegrams back to back and match the answers to the
+        requests afterwards, by module and register.
 
-            elif answer_hex[i:i + 2] == self._soe or answer_hex[i:i + 2] == self._soe.lower():
-                SpecialChar = 1
+        Input: requests: list of (dest, type, register, data) as for
+            send_telegram
+        Output: list of Telegram, or None where no valid answer was
+            received, in the order of the requests
+        '''
+        replies = []
+        for start in range(0, len(requests), self._pipeline_depth):
+            chunk = requests[start:start + self._pipeline_depth]
+            frames = b''.join(telegram.encode(dest, self._host_id, type, register, data)
+                              for dest, type, register, data in chunk)
+            replies.extend(self._exchange_frames(frames, chunk))
+        return replies
+
+    def _exchange_frames(self, frames, requests):
+        '''
+        Send encoded telegrams back to back and return the answers matched
+        to their requests (dest, type, register, data).
+        '''
+        replies = [None] * len(requests)
+        pending = {}
+        for i, (dest, type, register, data) in enumerate(requests):
+            pending.setdefault((dest, register), collections.deque()).append(i)
+        unexpected = False
+        for answer in self._ask_raw_many(frames, len(requests)):
+            try:
+                reply = telegram.decode(answer)
+            except telegram.TelegramError as e:
+                print('Invalid answer telegram: {}'.format(e))
+                continue
+            if not reply.crc_ok:
+                print("CRC ERROR in receiving answer telegram from {}".format(reply.source))
+                print(f"Recived message: {answer.hex()}")
+                continue
+            queue = pending.get((reply.source, reply.register))
+            if queue and telegram.is_answer(reply, self._host_id, reply.source,
+                                            requests[queue[0]][1], reply.register):
+                replies[queue.popleft()] = reply
             else:
-                if SpecialChar == 1:
-                    # adapt byte for special character case
-                    answer_hex_filtered += ("%0.2x" % (int(answer_hex[i:i + 2], 16) - self._addVal))
-                    SpecialChar = 0
-                else:
-                    # no special treatment
-                    answer_hex_filtered += answer_hex[i:i + 2]
-
-        data_ordered = '';
-        for i in reversed(range(8, len(answer_hex_filtered) - 4, 2)):  # select data bytes and flip data order
-            data_ordered += answer_hex_filtered[i:i + 2];
-        answer_ordered = answer_hex_filtered[0:8] + data_ordered + answer_hex_filtered[len(answer_hex_filtered) - 4:];
-        # Answer is structured like this:
-        if debug:
-            print("HW exchange:")
-            print(message_full)
-            print(answer)
-            print(answer_ordered)
+                print('Skipping answer telegram not matching a request: ' + reply.hex())
+                unexpected = True
+        if unexpected:
+            # Answers of this exchange may still be on their way
+            with self._io_lock:
+                self._aotf_reader.flush()
+        for request, reply in zip(requests, replies):
+            self._track_register(*request, reply)
+        return replies
+
+    def write_registers(self, writes, force=False):
+        '''
+        Write several registers in one pipelined exchange. Registers the
+        shadow shows to hold the data already are skipped.
+
+        Input: writes: list of (dest_add, register_in, data_in), hex
+            strings as for send_command
+        Output: list of (dest_add, register_in, data_in, answer) for the
+            writes that were not acknowledged
+        '''
+        requests = []
+        sent = []
+        for write in writes:
+            dest_add, register_in, data_in = write
+            dest = int(dest_add, 16)
+            register = int(register_in, 16)
+            data = bytes.fromhex(data_in)[::-1]
+            if self._skip_write(dest, register, data, force):
+                continue
+            requests.append((dest, telegram.TYPE_WRITE, register, data))
+            sent.append(tuple(write))
+
+        failed = []
+        for write, reply in zip(sent, self.send_telegrams(requests)):
+            if reply is None or reply.type != telegram.TYPE_ACK:
+                failed.append(write + ('' if reply is None else reply.hex(),))
+        return failed
 
-        return answer_ordered;
+    def invalidate_registers(self, dest_add=None):
+        '''
+        Forget the shadowed register contents, e.g. after the laser was
+        power cycled or changed from its front panel. The next write of
+        every register goes to the device.
+        '''
+        self._shadow.invalidate(None if dest_add is None else int(dest_add, 16))
+
+    def resync_registers(self):
+        '''
+        Read all shadowed registers back from the device.
+        '''
+        self._shadow.invalidate()
+        for dest, register in self._shadow.registers():
+            self.send_telegram(dest, telegram.TYPE_READ, register)
+
+    def get_register_stats(self):
+        '''
+        Return the number of register writes sent and skipped because the
+        register already held the value.
+        '''
+        return {'sent': self._shadow.sent, 'skipped': self._shadow.skipped}
 
     def calculate_crc(self, d_in):
         '''
@@ -286,14 +566,34 @@ class SuperK_2014(Instrument):
         d_in must be a hex string (without 0x)
         Output is a hex string (with 0x)
         '''
-        tmp = hex(CrcXmodem.calc(unhexlify(d_in)));
-        if len(tmp) == 5:
-            tmp = tmp[0:2] + '0' + tmp[2:];
-        elif len(tmp) == 4:
-            tmp = tmp[0:2] + '00' + tmp[2:];
-        elif len(tmp) == 3:
-            tmp = tmp[0:2] + '000' + tmp[2:];
-        return tmp;
+        return '0x%04x' % crc_xmodem(bytes.fromhex(d_in));
+
+    def do_get_many(self, names):
+        '''
+        Read power, wavelength, output and state in one pipelined
+        exchange.
+
+        Input: names: list of parameter names
+        Output: dictionary of parameter -> value for the parameters read
+        '''
+        reads = {'power': ((self._rf_address, 'b0'),),
+                 'wavelength': ((self._rf_address, '90'),),
+                 'output': ((self._select_address, '34'),),
+                 'state': ((self._rf_address, '30'), (self._select_address, '30'))}
+        names = [name for name in names if name in reads]
+        requests = [(int(dest_add, 16), telegram.TYPE_READ, int(register_in, 16), b'')
+                    for name in names for dest_add, register_in in reads[name]]
+        replies = iter(self.send_telegrams(requests))
+        values = {}
+        for name in names:
+            answers = ['' if reply is None else reply.hex()
+                       for reply in [next(replies) for i in reads[name]]]
+            try:
+                values[name] = getattr(self, '_%s_from_answer' % name)(*answers)
+            except ValueError:
+                # Left to the single parameter get
+                pass
+        return values
 
     def do_get_power(self, channel=None):
         '''
@@ -302,6 +602,9 @@ class SuperK_2014(Instrument):
         if channel == None:
             channel = 0
         answer = self.send_command(self._rf_address, '04', 'b' + str(channel), '');
+        return self._power_from_answer(answer);
+
+    def _power_from_answer(self, answer):
         if answer[4:6] != '08':
             print('Power was not retrieved correctly! Answer: ' + answer)
         return int(answer[-10:-4], 16) * 0.1;
@@ -314,22 +617,24 @@ class SuperK_2014(Instrument):
             value = 1
         value_tmp = "%0.4X" % int(value * 10);
         n_wavel_in = self.get_n_wavel();
+        writes = []
         for i in range(8):
             if n_wavel_in > i:  # sum the power of the adjacent WL
-                answer = self.send_command(self._rf_address, '05', 'b' + str(i), value_tmp);
-                if answer[4:6] != '03':
-                    print('Power not set correctly! Answer: ' + answer)
+                writes.append((self._rf_address, 'b' + str(i), value_tmp))
             else:
                 # set the others to 0
-                answer = self.send_command(self._rf_address, '05', 'b' + str(i), "%0.4X" % (0 * 10));
+                writes.append((self._rf_address, 'b' + str(i), "%0.4X" % (0 * 10)))
+        for dest_add, register_in, data_in, answer in self.write_registers(writes):
+            if data_in == value_tmp:
+                print('Power not set correctly! Answer: ' + answer)
 
     def do_set_power(self, value, channel=0):
         '''
         Set power output to value (%)
         '''
         value_tmp = "%0.4X" % int(value * 10);
-        answer = self.send_command(self._rf_address, '05', 'b' + str(channel), value_tmp);
-        if answer[4:6] != '03':
+        answer = self.write_register(self._rf_address, 'b' + str(channel), value_tmp);
+        if answer is not None and answer[4:6] != '03':
             print('Power not set correctly! Answer: ' + answer)
 
     def do_get_power_density(self):
@@ -410,49 +715,65 @@ class SuperK_2014(Instrument):
         Get selected wavelength
         '''
         answer = self.send_command(self._rf_address, '04', '90', '');
+        return self._wavelength_from_answer(answer);
+
+    def _wavelength_from_answer(self, answer):
         if answer[4:6] != '08':
             print('Wavelength not retrieved correctly! Answer: ' + answer)
         return int(answer[-10:-4], 16) * 0.001;
 
+    def _wavelength_writes(self, value, delta_wavel_in, nir=False):
+        '''
+        Return the writes of the eight wavelength registers 0x90-0x97,
+        spaced by delta_wavel_in, as (dest_add, register_in, data_in).
+        '''
+        writes = []
+        for i in range(8):
+            factor = float(i) * delta_wavel_in;
+            value_tmp = "%0.8X" % int((value + factor) * 1000);
+            # value_tmp = hex(int((value + factor) * 1000))
+            if nir:
+                value_tmp = value_tmp[2:]
+            writes.append((self._rf_address, '9' + str(i), value_tmp))
+        return writes
+
+    def _set_wavelength_registers(self, value, delta_wavel_in, nir=False):
+        '''
+        Write the eight wavelength registers 0x90-0x97 in one pipelined
+        exchange, spaced by delta_wavel_in.
+        '''
+        writes = self._wavelength_writes(value, delta_wavel_in, nir)
+        for dest_add, register_in, data_in, answer in self.write_registers(writes):
+            print('Wavelength not set correctly! Answer: ' + answer)
+
     def do_set_wavelength(self, value):
         '''
         Set wavelength
         '''
         delta_wavel_in = self.get_delta_wavel();
+        output = self._known_value('output');
 
         # Check whether wavelength value is within allowed range
-        if self.get_output() == 'VIS/NIR':
+        if output == 'VIS/NIR':
             if value < 640 or value > 1100:
                 print('Given value is out of range for VIS/NIR output (640-1100nm)!')
                 value_tmp = "%0.8X" % int(640 * 1000);
                 # value_tmp = hex(int(640 * 1000))
-                answer = self.send_command(self._rf_address, '05', '90', value_tmp);
-                if answer[4:6] != '03':
+                answer = self.write_register(self._rf_address, '90', value_tmp);
+                if answer is not None and answer[4:6] != '03':
                     print('Wavelength not set correctly! Answer: ' + answer)
             else:
-                for i in range(8):
-                    factor = float(i) * delta_wavel_in;
-                    value_tmp = "%0.8X" % int((value + factor) * 1000);
-                    # value_tmp = hex(int((value + factor) * 1000))
-                    answer = self.send_command(self._rf_address, '05', '9' + str(i), value_tmp);
-                    if answer[4:6] != '03':
-                        print('Wavelength not set correctly! Answer: ' + answer)
-        elif self.get_output() == 'NIR/IR':
+                self._set_wavelength_registers(value, delta_wavel_in)
+        elif output == 'NIR/IR':
             if value < 1155 or value > 2000:
                 print('Given value is out of range for NIR/IR output (1155-2000nm)!')
                 value_tmp = "%0.8X" % int(1200 * 1000);
                 # value_tmp = hex(int(1200 * 1000))
-                answer = self.send_command(self._rf_address, '05', '90', value_tmp);
-                if answer[4:6] != '03':
+                answer = self.write_register(self._rf_address, '90', value_tmp);
+                if answer is not None and answer[4:6] != '03':
                     print('Wavelength not set correctly! Answer: ' + answer)
             else:
-                for i in range(8):
-                    factor = i * delta_wavel_in;
-                    value_tmp = "%0.8X" % int((value + factor) * 1000);
-                    # value_tmp = hex(int((value+factor)*1000))
-                    answer = self.send_command(self._rf_address, '05', '9' + str(i), value_tmp[2:]);
-                    if answer[4:6] != '03':
-                        print('Wavelength not set correctly! Answer: ' + answer)
+                self._set_wavelength_registers(value, delta_wavel_in, nir=True)
         #        answer = self.send_command(self._rf_address,'05','90',value_tmp);
         #        if answer[4:6] != '03':
         #            print('Wavelength not set correctly! Answer: ' + answer)
@@ -469,25 +790,13 @@ class SuperK_2014(Instrument):
             raise WavelengthERROR('Given value is out of range! {}'.format(value))
         # Check whether wavelength value is within allowed range
         if (value > 640 and value < 1100):
-            if self.get_output() != 'VIS/NIR':
+            if self._known_value('output') != 'VIS/NIR':
                 self.set_output('VIS/NIR')
-            for i in range(8):
-                factor = float(i) * delta_wavel_in;
-                value_tmp = "%0.8X" % int((value + factor) * 1000);
-                # value_tmp = hex(int((value + factor) * 1000))
-                answer = self.send_command(self._rf_address, '05', '9' + str(i), value_tmp);
-                if answer[4:6] != '03':
-                    print('Wavelength not set correctly! Answer: ' + answer)
+            self._set_wavelength_registers(value, delta_wavel_in)
         elif (value > 1155 and value < 2000):
-            if self.get_output() != 'NIR/IR':
+            if self._known_value('output') != 'NIR/IR':
                 self.set_output('NIR/IR')
-            for i in range(8):
-                factor = i * delta_wavel_in;
-                value_tmp = "%0.8X" % int((value + factor) * 1000);
-                # value_tmp = hex(int((value+factor)*1000))
-                answer = self.send_command(self._rf_address, '05', '9' + str(i), value_tmp[2:]);
-                if answer[4:6] != '03':
-                    print('Wavelength not set correctly! Answer: ' + answer)
+            self._set_wavelength_registers(value, delta_wavel_in, nir=True)
         if self._testvar != 1:
             self.update('wavelength', value);
 
@@ -496,9 +805,12 @@ class SuperK_2014(Instrument):
         Get state
         '''
         answer1 = self.send_command(self._rf_address, '04', '30', '');
+        answer2 = self.send_command(self._select_address, '04', '30', '');
+        return self._state_from_answer(answer1, answer2);
+
+    def _state_from_answer(self, answer1, answer2):
         if answer1[4:6] != '08':
             print('State not retrieved correctly! Answer: ' + answer1)
-        answer2 = self.send_command(self._select_address, '04', '30', '');
         if answer2[4:6] != '08':
             print('State not retrieved correctly! Answer: ' + answer2)
         if int(answer1[8:10], 16) >= 1 and int(answer2[8:10], 16) == 0:
@@ -553,6 +865,9 @@ class SuperK_2014(Instrument):
         Get output (VIS/NIR or NIR/IR)
         '''
         answer = self.send_command(self._select_address, '04', '34', '');
+        return self._output_from_answer(answer);
+
+    def _output_from_answer(self, answer):
         if answer[4:6] != '08':
             print('State not retrieved correctly! Answer: ' + answer)
         if int(answer[8:10], 16) == 1:
@@ -567,82 +882,57 @@ class SuperK_2014(Instrument):
         '''
         Set output (VIS/NIR or NIR/IR)
         '''
-        if value == 'VIS/NIR':
-            # Select output RF switch
-            answer = self.send_command(self._select_address, '05', '34', '00');
-            if answer[4:6] != '03':
-                print('Output not set correctly! Answer: ' + answer)
+        if value not in self._output_registers:
+            print('Invalid output: ' + value)
+            return
+        select_value = self._output_registers[value][0]
+        # Select output RF switch
+        answer = self.write_register(self._select_address, '34', select_value);
+        if answer is not None and answer[4:6] != '03':
+            print('Output not set correctly! Answer: ' + answer)
+        # Crystal parameters (minimum / maximum wavelength, temperature and
+        # frequency coefficients) and optimal power table are copied from
+        # the Select to the RF driver.
+        params = self._read_output_params(value)
+        if params is None:
+            return
+        writes = self._crystal_writes(value, params) + self._power_table_writes(params)
+        for dest_add, register_in, data_in, answer in self.write_registers(writes):
+            print('Output parameter {} not set correctly! Answer: {}'.format(register_in, answer))
+
+    def _read_output_params(self, output):
+        '''
+        Read the crystal parameters and optimal power table of an output
+        from the Select module in one pipelined exchange.
+        '''
+        select = int(self._select_address, 16)
+        crystal_registers, table_register = self._output_registers[output][1:]
+        requests = [(select, telegram.TYPE_WRITE, 0x8F, bytes(4))]
+        requests += [(select, telegram.TYPE_READ, int(r, 16), b'') for r in crystal_registers]
+        requests += [(select, telegram.TYPE_READ, int(table_register, 16), b'')] * 5
+        requests += [(select, telegram.TYPE_READ, 0x8F, b'')]
+        replies = self.send_telegrams(requests)
+        for reply in replies[1:-1]:
+            if reply is None or reply.type != telegram.TYPE_DATAGRAM:
+                print('Output parameters not retrieved correctly! Answer: ' +
+                      ('' if reply is None else reply.hex()))
+                return None
+        crystal = [reply.hex()[8:-4] for reply in replies[1:6]]
+        table = ''.join(reply.hex()[8:-8].rjust(160, '0') for reply in replies[6:11])
+        return {'crystal': crystal, 'table': table}
+
+    def _crystal_writes(self, output, params):
+        writes = [(self._rf_address, register_in, data_in)
+                  for register_in, data_in in zip(('34', '35', '36', '37', '39'), params['crystal'])]
+        if output == 'VIS/NIR':
             # Temperature
-            #            answer = self.send_command(self._rf_address,'05','38','00E2');
-            # Minimum / Maximum wavelengths (640 - 1100 nm)
-            # read crystal parameters and program to rf select
-            answer_read = self.send_command(self._select_address, '04', '90', '');  # Minimum Wavelength (640 nm)
-            answer = self.send_command(self._rf_address, '05', '34', answer_read[8:-4]);  # Minimum Wavelength (640 nm)
-            answer_read = self.send_command(self._select_address, '04', '91', '');  # Minimum Wavelength (640 nm)
-            answer = self.send_command(self._rf_address, '05', '35', answer_read[8:-4]);  # Maximum Wavelength (1100 nm)
-            # Temperature, frequency coefficients
-            answer_read = self.send_command(self._select_address, '04', '92', '');
-            answer = self.send_command(self._rf_address, '05', '36', answer_read[8:-4]);
-            answer_read = self.send_command(self._select_address, '04', '93', '');
-            answer = self.send_command(self._rf_address, '05', '37', answer_read[8:-4]);
-            answer = self.send_command(self._rf_address, '05', '38', '00E2');
-            answer_read = self.send_command(self._select_address, '04', '94', '');
-            answer = self.send_command(self._rf_address, '05', '39', answer_read[8:-4]);
-            # answer = self.send_command(self._select_address,'05','8F','00000000');
-            # # Read Optimal power table from Select and write in RF driver
-            # data = '';
-            # for i in range(10):
-            # answer_read = self.send_command(self._select_address,'04','95','');
-            # if len(answer_read[8:-8])==160:
-            # data = data + answer_read[8:-8];
-            # else:
-            # tmp = '';
-            # for i in range(160-len(answer_read[8:-8])):
-            # tmp += '0';
-            # data = data + tmp + answer_read[8:-8];
-            # answer = self.send_command(self._rf_address,'05','8F','00000000');
-            # for i in range(10):
-            # answer = self.send_command(self._rf_address,'05','3A',data[i*160:i*160+160]);
-            # #            print( data);
-            self.update_power_table();
+            writes.insert(4, (self._rf_address, '38', '00E2'))
+        return writes
 
-        elif value == 'NIR/IR':
-            # Select output RF switch
-            answer = self.send_command(self._select_address, '05', '34', '01');
-            if answer[4:6] != '03':
-                print('Output not set correctly! Answer: ' + answer)
-            # Temperature
-            #            answer = self.send_command(self._rf_address,'05','38','00E2');
-            # Minimum / Maximum wavelengths
-            answer_read = self.send_command(self._select_address, '04', 'A0', '');  # Minimum Wavelength ( nm)
-            answer = self.send_command(self._rf_address, '05', '34', answer_read[8:-4]);  # Minimum Wavelength ( nm)
-            answer_read = self.send_command(self._select_address, '04', 'A1', '');  # Minimum Wavelength ( nm)
-            answer = self.send_command(self._rf_address, '05', '35', answer_read[8:-4]);  # Maximum Wavelength ( nm)
-            # Temperature, frequency coefficients
-            answer_read = self.send_command(self._select_address, '04', 'A2', '');
-            answer = self.send_command(self._rf_address, '05', '36', answer_read[8:-4]);
-            answer_read = self.send_command(self._select_address, '04', 'A3', '');
-            answer = self.send_command(self._rf_address, '05', '37', answer_read[8:-4]);
-            answer_read = self.send_command(self._select_address, '04', 'A4', '');
-            answer = self.send_command(self._rf_address, '05', '39', answer_read[8:-4]);
-            # answer = self.send_command(self._select_address,'05','8F','00000000');
-            # # Read Optimal power table from Select and write in RF driver
-            # data = '';
-            # for i in range(10):
-            # answer_read = self.send_command(self._select_address,'04','95','');
-            # if len(answer_read[8:-8])==160:
-            # data = data + answer_read[8:-8];
-            # else:
-            # tmp = '';
-            # for i in range(160-len(answer_read[8:-8])):
-            # tmp += '0';
-            # data = data + tmp + answer_read[8:-8];
-            # answer = self.send_command(self._rf_address,'05','8F','00000000');
-            # for i in range(10):
-            # answer = self.send_command(self._rf_address,'05','3A', data[i*160:i*160+160]);
-            self.update_power_table();
-        else:
-            print('Invalid output: ' + value)
+    def _power_table_writes(self, params):
+        table = params['table']
+        return ([(self._rf_address, '8F', '00000000')] +
+                [(self._rf_address, '3A', table[i * 160:i * 160 + 160]) for i in range(5)])
 
     def modulate_shutter(self, duration, period):
         per = float(period) / 2;
@@ -656,96 +946,129 @@ class SuperK_2014(Instrument):
                 self.set_shutter('closed');
             time.sleep(per / 1000);
 
-    def read_all_registers(self, name):
-        f = open('Q:\\superk_list_' + name + '.txt', 'a');
-        for i in range(256):
-            add = hex(i).split('x')[1];
-            if len(add) == 1:
-                add = '0' + add;
-            answer_tmp1 = self.send_command(self._select_address, '04', add, '');
-            line_tmp = answer_tmp1 + '\n';
-            f.writelines(line_tmp);
-        for i in range(256):
-            add = hex(i).split('x')[1];
-            if len(add) == 1:
-                add = '0' + add;
-            answer_tmp2 = self.send_command(self._rf_address, '04', add, '');
-            line_tmp = answer_tmp2 + '\n';
-            f.writelines(line_tmp);
-        f.write('\n');
-        f.close();
-
-    def update_power_table(self):
-        if self.get_output() == 'VIS/NIR':
-            # Read Optimal power table from Select and write in RF driver
-            answer = self.send_command(self._select_address, '05', '8F', '00000000');
-            data = '';
-            for i in range(5):
-                answer_read = self.send_command(self._select_address, '04', '95', '');
-                #                print( answer_read)
-                if len(answer_read[8:-8]) == 160:
-                    data = data + answer_read[8:-8];
+    def snapshot_registers(self, modules=None, registers=range(256)):
+        '''
+        Read registers of the Select and RF modules with pipelined
+        requests. Registers a module has reported not to have are not
+        asked for again.
+
+        Input:
+            modules (list of hex strings): module addresses, default Select
+                and RF
+            registers (iterable of int): register addresses
+        Output: RegisterSnapshot
+        '''
+        if modules is None:
+            modules = (self._select_address, self._rf_address)
+        requests = [(int(dest_add, 16), telegram.TYPE_READ, register, b'')
+                    for dest_add in modules for register in registers
+                    if (int(dest_add, 16), register) not in self._absent_registers]
+        snapshot = RegisterSnapshot()
+        for request, reply in zip(requests, self.send_telegrams(requests)):
+            key = (request[0], request[2])
+            if reply is None:
+                continue
+            if reply.type == telegram.TYPE_DATAGRAM:
+                snapshot.registers[key] = reply.data
+            elif reply.type == telegram.TYPE_NACK:
+                self._absent_registers.add(key)
+        snapshot.absent.update(self._absent_registers)
+        return snapshot
+
+    def read_all_registers(self, name, dirname='Q:\\'):
+        '''
+        Save a snapshot of all Select and RF registers to
+        <dirname>superk_list_<name>.sks and return it. Use
+        superk_snapshot.diff to compare two snapshots.
+        '''
+        snapshot = self.snapshot_registers()
+        snapshot.save(os.path.join(dirname, 'superk_list_' + name + '.sks'))
+        return snapshot
+
+    def update_power_table(self, output=None):
+        '''
+        Copy the optimal power table of the given (default: current)
+        output from the Select module to the RF driver.
+        '''
+        if output is None:
+            output = self._known_value('output')
+        params = self._read_output_params(output)
+        if params is None:
+            return
+        for dest_add, register_in, data_in, answer in self.write_registers(self._power_table_writes(params)):
+            print('Power table not set correctly! Answer: ' + answer)
+
+    def restore_registers(self, snapshot, reference=None, use_shadow=False, emission=False):
+        '''
+        Bring the modules to the register contents of a snapshot. Only the
+        writable configuration registers (output, crystal parameters,
+        wavelengths and powers) that differ from the current contents are
+        written, in one pipelined batch with acknowledge checking.
+
+        Input:
+            snapshot (RegisterSnapshot): contents to restore
+            reference (RegisterSnapshot): current contents of the device.
+                If None, the registers in 'snapshot' are read from the
+                device first.
+            use_shadow (bool): take registers the driver shadow knows from
+                the shadow instead of reading them. Do not use after a
+                power cycle.
+            emission (bool): also restore the emission state. It is
+                written last, only if all other writes were acknowledged.
+        Output: list of (module, register, data, answer) for the writes
+            that were not acknowledged; answer is '' for emission writes
+            not sent because of an earlier failure
+        '''
+        order = self._restore_order
+        if emission:
+            order += self._emission_registers
+        keys = [key for key in order if key in snapshot.registers]
+        if reference is None:
+            reference = RegisterSnapshot()
+            to_read = []
+            for dest, register in keys:
+                known = self._shadow.get(dest, register) if use_shadow else None
+                if known is not None:
+                    reference.registers[(dest, register)] = known
                 else:
-                    tmp = '';
-                    for i in range(160 - len(answer_read[8:-8])):
-                        tmp += '0';
-                    data = data + tmp + answer_read[8:-8];
-            answer = self.send_command(self._select_address, '04', '8F', '');
-            #            print( '118F after reading: ' + answer)
-            #            print( 'len(data)' + str(len(data)))
-
-            answer = self.send_command(self._rf_address, '05', '8F', '00000000');
-            for i in range(5):
-                answer = self.send_command(self._rf_address, '05', '3A', data[i * 160:i * 160 + 160]);
-            #                print( data[i*160:i*160+160])
-            answer = self.send_command(self._rf_address, '04', '8F', '');
-        #            print '068F after reading: ' + answer;
-        else:
-            # Read Optimal power table from Select and write in RF driver
-            answer = self.send_command(self._select_address, '05', '8F', '00000000');
-            data = '';
-            for i in range(5):
-                answer_read = self.send_command(self._select_address, '04', 'A5', '');
-                #                print answer_read;
-                if len(answer_read[8:-8]) == 160:
-                    data = data + answer_read[8:-8];
+                    to_read.append((dest, telegram.TYPE_READ, register, b''))
+            for request, reply in zip(to_read, self.send_telegrams(to_read)):
+                if reply is not None and reply.type == telegram.TYPE_DATAGRAM:
+                    reference.registers[(request[0], request[2])] = reply.data
+
+        writes = []
+        emission_writes = []
+        for dest, register in keys:
+            data = snapshot.registers[(dest, register)]
+            if reference.get(dest, register) != data:
+                write = ('%02X' % dest, '%02X' % register, data[::-1].hex().upper())
+                if (dest, register) in self._emission_registers:
+                    emission_writes.append(write)
                 else:
-                    tmp = '';
-                    for i in range(160 - len(answer_read[8:-8])):
-                        tmp += '0';
-                    data = data + tmp + answer_read[8:-8];
-            answer = self.send_command(self._select_address, '04', '8F', '');
-            #            print '118F after reading: ' + answer;
-            #            print 'len(data)' + str(len(data));
-
-            answer = self.send_command(self._rf_address, '05', '8F', '00000000');
-            for i in range(5):
-                answer = self.send_command(self._rf_address, '05', '3A', data[i * 160:i * 160 + 160]);
-            #                print data[i*160:i*160+160];
-            answer = self.send_command(self._rf_address, '04', '8F', '');
-
-    #            print '068F after reading: ' + answer;
-
-    def write_all_registers(self, name):
-        f_out = open('Q:\\superk_list_' + name + '_wr.txt', 'a');
-        with open('Q:\\superk_list_' + name + '.txt', 'r') as f:
-            for line in f:
-                #                tmp = f.readline()[0:-2];
-                tmp = line[0:-1];
-                if tmp[4:6] == '08':
-                    add = tmp[2:4];
-                    reg_add = tmp[6:8];
-                    data = tmp[8:-4];
-                    if np.mod(len(data), 2) == 0:
-                        #                        self.send_command(add,'05',reg_add,data);
-                        f_out.writelines('Command: ' + add + '05' + reg_add + data + '\n');
-                    else:
-                        print('Data length differs from mod 2')
-                        print(str(tmp))
-                        print(data)
-        #                        self.send_command(add,'05',reg_add,'0'+data);
-        f_out.write('\n');
-        f_out.close();
+                    writes.append(write)
+        failed = self.write_registers(writes, force=True)
+        if emission_writes:
+            if failed:
+                failed += [write + ('',) for write in emission_writes]
+            else:
+                failed = self.write_registers(emission_writes, force=True)
+        failed = [(int(dest_add, 16), int(register_in, 16), bytes.fromhex(data_in)[::-1], answer)
+                  for dest_add, register_in, data_in, answer in failed]
+        if writes or emission_writes:
+            # Output, state, power and wavelength may have changed
+            self.get_all()
+        return failed
+
+    def write_all_registers(self, name, dirname='Q:\\'):
+        '''
+        Restore the registers saved by read_all_registers(name, dirname).
+        See restore_registers.
+        '''
+        snapshot = RegisterSnapshot.load(os.path.join(dirname, 'superk_list_' + name + '.sks'))
+        failed = self.restore_registers(snapshot)
+        for dest, register, data, answer in failed:
+            print('Register {:02X} of module {:02X} not restored! Answer: {}'.format(register, dest, answer))
+        return failed
 
     def set_irr_calibration(self, path_to_calibration_file, ir_file=None, vis_file=None, area=None):
         '''
@@ -769,6 +1092,52 @@ class SuperK_2014(Instrument):
 
             self.vis_calibration_file = os.path.join(path_to_calibration_file, vis_file)
 
+        self._load_calibration_tables()
+
+    def _load_calibration_tables(self):
+        '''
+        Map the calibration tables of both outputs, building them if the
+        calibration files changed.
+        '''
+        for filename in (self.vis_calibration_file, self.ir_calibration_file):
+            try:
+                calibration.tables.get(filename)
+            except (IOError, OSError):
+                logging.debug('No calibration file %s', filename)
+            except ValueError as e:
+                logging.warning('Invalid calibration file %s: %s', filename, e)
+
+    def _calibration_for(self, output=None):
+        '''
+        Return (calibration table, calibration area) of an output, or None
+        if its calibration file cannot be read.
+        '''
+        if output is None:
+            output = self._known_value('output');
+        if output == 'VIS/NIR':
+            filename = self.vis_calibration_file
+            cal_area = self.calibration_area_vis
+        elif output == 'NIR/IR':
+            filename = self.ir_calibration_file
+            cal_area = self.calibration_area_ir
+        else:
+            print('Unknown output: ' + str(output))
+            return None
+        try:
+            return calibration.tables.get(filename), cal_area
+        except (IOError, OSError):
+            print('Error: Calibration file ' + filename + ' not found!')
+            return None
+        except ValueError as e:
+            print('Error: Calibration file ' + filename + ' is invalid: ' + str(e))
+            return None
+
+    def _inv_calibration_area(self, output):
+        # Spot areas used for the inverse calibration
+        if output == 'VIS/NIR':
+            return np.pi * (1e-3 / 2) ** 2;
+        return np.pi * (2e-3 / 2) ** 2;
+
     def get_power_calibration(self, power_density, wavel, power_density_bool=True):
         '''
         This function reads the calibration data of the SuperK laser and
@@ -784,66 +1153,23 @@ class SuperK_2014(Instrument):
         VIS/NIR: 'cal_curve_SuperK_VIS-NIR.dat'
         NIR/IR: 'cal_curve_SuperK_NIR-IR.dat'
         '''
-        laser_output = self.get_output();  # VIS/NIR or NIR/IR
-        if laser_output == 'VIS/NIR':
-            cal_area = self.calibration_area_vis
-            filename = self.vis_calibration_file
-
-        elif laser_output == 'NIR/IR':
-            cal_area = self.calibration_area_ir
-            filename = self.ir_calibration_file
-
-        # Get calibration data from file
-        try:
-            f = open(filename, 'r');
-        except IOError:
-            print('Error: Calibration file ' + filename + ' not found!')
-            relative_power = -1;
-        else:
-            wavelength_list = [];
-            relative_power_list = [];
-            absolute_power_list = [];
-            # Read calibration data
-            for line in f:
-                if (line[0] != '#') and (len(line) > 5):
-                    tmp = line.replace('\n', '').split('\t');
-                    wavelength_list.append(float(tmp[0]));
-                    relative_power_list.append(float(tmp[1]));
-                    if power_density_bool:
-                        absolute_power_list.append(float(tmp[2]) / cal_area);  # Converted to power density
-                    else:
-                        absolute_power_list.append(float(tmp[2]));  # Converted to power density
-                    # relative_power_list.append(float(tmp[0]));
-                    # wavelength_list.append(float(tmp[1]));
-                    # absolute_power_list.append(float(tmp[2])/cal_area);
-            f.close();
-
-            absolute_power_list_arr = np.array(absolute_power_list);
-
-            # Get calibration data for the desired wavelength
-            rel_power_list = [];  # List of relative powers for desired wavelength
-            abs_power_list = [];  # List of absolute powers for desired wavelength
-            wavelength_list_unique = np.unique(wavelength_list);
-            n_wavel_cal = len(wavelength_list_unique);
-            n_power_cal = len(wavelength_list) / n_wavel_cal;
-            # Carry out interpolation in wavelength for each power
-            for p in range(int(n_power_cal)):
-                rel_power_list.append(np.interp(wavel, wavelength_list_unique,
-                                                relative_power_list[p * n_wavel_cal:(p + 1) * n_wavel_cal]));
-                abs_power_list.append(np.interp(wavel, wavelength_list_unique,
-                                                absolute_power_list_arr[p * n_wavel_cal:(p + 1) * n_wavel_cal]));
-
-            # Perform interpolation in power to find needed SuperK power in percentage
-            fine_rel_power_list = list(np.arange(0, 100, 0.1));
-            fine_abs_power_list = np.interp(fine_rel_power_list, rel_power_list, abs_power_list);
-            tmp = abs(np.array(fine_abs_power_list) - power_density);
-            relative_power = fine_rel_power_list[list(tmp).index(min(tmp))];
-
-            #            relative_power = np.interp(power_density, abs_power_list, rel_power_list);
-            if power_density < min(abs_power_list) or power_density > max(abs_power_list):
-                print('Required power density is out of calibrated range for the selected wavelength!')
-                print(min(abs_power_list))
-                print(max(abs_power_list))
+        cal = self._calibration_for()
+        if cal is None:
+            return -1;
+        table, cal_area = cal
+        scale = cal_area if power_density_bool else 1.0
+
+        # Look up needed SuperK power in percentage in the inverse calibration table
+        relative_power = float(table.relative_power_at(power_density * scale, wavel));
+        if not table.is_monotonic(wavel):
+            print('Warning: calibrated power does not increase monotonically with relative power at %s nm,' % wavel)
+            print('using the lowest relative power reaching the required power density')
+
+        min_power, max_power = table.power_range(wavel)
+        if power_density < min_power / scale or power_density > max_power / scale:
+            print('Required power density is out of calibrated range for the selected wavelength!')
+            print(min_power / scale)
+            print(max_power / scale)
 
         return relative_power;
 
@@ -861,75 +1187,232 @@ class SuperK_2014(Instrument):
         VIS/NIR: 'cal_curve_SuperK_VIS-NIR.dat'
         NIR/IR: 'cal_curve_SuperK_NIR-IR.dat'
         '''
-        dirname = 'C:/ROIC-SW/testsystem-sw/GRACE_software/python/Configuration/Supk_extreme/'
-        laser_output = self.get_output();  # VIS/NIR or NIR/IR
-        if laser_output == 'VIS/NIR':
-            filename = 'Supk_extreme_callibration_dot_2mmVis_3mmIr_vis.txt'
-            filename = 'SuperK_cal_VISvis.txt'
-            cal_area = np.pi * (1e-3 / 2) ** 2;
-
-        elif laser_output == 'NIR/IR':
-
-            filename = 'Supk_extreme_callibration_dot_2mmVis_3mmIr_ir.txt'
-            filename = 'SuperK_cal_IRir.txt'
-            cal_area = np.pi * (2e-3 / 2) ** 2;
-
+        laser_output = self._known_value('output');  # VIS/NIR or NIR/IR
+        cal = self._calibration_for(laser_output)
+        if cal is None:
+            return -1;
+        table = cal[0]
         # Calibration is done through a 1mm diameter pinhole in front of the powermeter
         # cal_area = np.pi * (1e-3/2)**2;
         # Calibration is done using the small collimator
         # Calibration is done using big collimator
         # cal_area = np.pi * (0.98e-2/2)**2
-        # Get calibration data from file
-        try:
-            f = open(dirname + filename, 'r');
-        except IOError:
-            print('Error: Calibration file ' + dirname + filename + ' not found!')
-            absolute_power = -1;
-        else:
-            wavelength_list = [];
-            relative_power_list = [];
-            absolute_power_list = [];
-            # Read calibration data
-            for line in f:
-                if (line[0] != '#') and (len(line) > 5):
-                    tmp = line.replace('\n', '').split('\t');
-                    wavelength_list.append(float(tmp[0]));
-                    relative_power_list.append(float(tmp[1]));
-                    absolute_power_list.append(float(tmp[2]) / cal_area);  # Converted to power density
-            f.close();
-
-            # Correct for offset of the powermeter
-            absolute_power_list_arr = np.array(absolute_power_list);
-            absolute_power_list_arr = absolute_power_list_arr - min(absolute_power_list);
-
-            # Get calibration data for the desired wavelength
-            rel_power_list = [];  # List of relative powers for desired wavelength
-            abs_power_list = [];  # List of absolute powers for desired wavelength
-            wavelength_list_unique = np.unique(wavelength_list);
-            n_wavel_cal = len(wavelength_list_unique);
-            n_power_cal = int(len(wavelength_list) / n_wavel_cal);
-            # Carry out interpolation in wavelength for each power
-            for p in range(n_power_cal):
-                rel_power_list.append(np.interp(wavel, wavelength_list_unique,
-                                                relative_power_list[p * n_wavel_cal:(p + 1) * n_wavel_cal]));
-                abs_power_list.append(np.interp(wavel, wavelength_list_unique,
-                                                absolute_power_list_arr[p * n_wavel_cal:(p + 1) * n_wavel_cal]));
-
-            # Perform interpolation in power to find delivered SuperK power density for the selected relative power
-            absolute_power = np.interp(power_relative, rel_power_list, abs_power_list);
-            if absolute_power * cal_area < 40e-9:
-                absolute_power = 0;
-                print('Power from calibration below calibration limit')
-            if power_relative < min(rel_power_list) or power_relative > max(rel_power_list):
-                print('Required relative power is out of calibrated range for the selected wavelength!')
-                print(min(rel_power_list))
-                print(max(rel_power_list))
+        cal_area = self._inv_calibration_area(laser_output)
+
+        # Look up delivered SuperK power density for the selected relative power,
+        # corrected for the offset of the powermeter
+        absolute_power = float(table.power_at(power_relative, wavel) - table.min_power) / cal_area;
+        if absolute_power * cal_area < 40e-9:
+            absolute_power = 0;
+            print('Power from calibration below calibration limit')
+        min_rel, max_rel = table.relative_range()
+        if power_relative < min_rel or power_relative > max_rel:
+            print('Required relative power is out of calibrated range for the selected wavelength!')
+            print(min_rel)
+            print(max_rel)
 
         return absolute_power;
 
+    def get_power_calibration_many(self, power_density, wavel, power_density_bool=True, output=None):
+        '''
+        Array version of get_power_calibration: returns the relative power (%)
+        needed for every (power_density, wavel) pair. Inputs are broadcast
+        against each other, so one power density can be resolved for many
+        wavelengths and vice versa.
+
+        Inputs:
+        power_density: Desired output power densities in W/m2 (W if
+            power_density_bool is False)
+        wavel: Wavelengths in nm
+        output: 'VIS/NIR' or 'NIR/IR', defaults to the current output
+
+        Output: array of relative powers, or -1 if the calibration file
+        cannot be read
+        '''
+        cal = self._calibration_for(output)
+        if cal is None:
+            return -1;
+        table, cal_area = cal
+        scale = cal_area if power_density_bool else 1.0
+        power_density, wavel = np.broadcast_arrays(
+            np.asarray(power_density, dtype=float), np.asarray(wavel, dtype=float))
+        power = power_density * scale
+        relative_power = table.relative_power_at(power, wavel)
+
+        bent = ~table.is_monotonic(wavel)
+        if np.any(bent):
+            print('Warning: calibrated power is not monotonic for %d of %d targets'
+                % (np.count_nonzero(bent), np.size(bent)))
+        min_power, max_power = table.power_range(wavel)
+        out = (power < min_power) | (power > max_power)
+        if np.any(out):
+            print('%d of %d required power densities are out of calibrated range!'
+                % (np.count_nonzero(out), np.size(out)))
+        return relative_power;
+
+    def get_power_calibration_inv_many(self, power_relative, wavel, output=None):
+        '''
+        Array version of get_power_calibration_inv: returns the power density
+        (W/m2) delivered for every (power_relative, wavel) pair, e.g. to
+        convert the relative powers recorded during a measurement. Inputs
+        are broadcast against each other.
+
+        Inputs:
+        power_relative: Relative powers in %
+        wavel: Wavelengths in nm
+        output: 'VIS/NIR' or 'NIR/IR', defaults to the current output
+
+        Output: array of power densities, or -1 if the calibration file
+        cannot be read
+        '''
+        if output is None:
+            output = self._known_value('output');
+        cal = self._calibration_for(output)
+        if cal is None:
+            return -1;
+        table = cal[0]
+        cal_area = self._inv_calibration_area(output)
+        power_relative = np.asarray(power_relative, dtype=float)
+        absolute_power = np.array((table.power_at(power_relative, wavel) - table.min_power) / cal_area)
+        low = absolute_power * cal_area < 40e-9
+        if low.any():
+            absolute_power[low] = 0;
+            print('%d of %d powers from calibration below calibration limit'
+                % (np.count_nonzero(low), low.size))
+        min_rel, max_rel = table.relative_range()
+        out = (power_relative < min_rel) | (power_relative > max_rel)
+        if np.any(out):
+            print('%d of %d required relative powers are out of calibrated range!'
+                % (np.count_nonzero(out), np.size(out)))
+        return absolute_power[()];
+
+    def compile_sweep(self, points, power_density=False):
+        '''
+        Compute and encode the register writes of a sweep in advance, so
+        run_sweep only has to send them.
+
+        Input:
+            points: list of (output, wavelength, power); power is the
+                relative power (%), or the power density (W/m2) if
+                power_density is True
+            power_density (bool): convert the power densities to relative
+                powers with the calibration of each output
+        Output: SweepPlan
+        '''
+        points = [tuple(point) for point in points]
+        densities = np.array([point[2] for point in points], dtype=float)
+        powers = densities.copy()
+        if power_density:
+            for output in set(point[0] for point in points):
+                if self._calibration_for(output) is None:
+                    raise IOError('No calibration for output ' + str(output))
+                index = [i for i, point in enumerate(points) if point[0] == output]
+                wavels = [points[i][1] for i in index]
+                powers[index] = self.get_power_calibration_many(densities[index], wavels, output=output)
+
+        delta_wavel_in = self.get_delta_wavel();
+        plan = SweepPlan(self._host_id, self._pipeline_depth)
+        for (output, wavel, value), power, density in zip(points, powers, densities):
+            if output not in self._wavelength_ranges:
+                raise ValueError('Invalid output: ' + str(output))
+            low, high = self._wavelength_ranges[output]
+            if wavel < low or wavel > high:
+                raise WavelengthERROR('Given value is out of range for {} output! {}'.format(output, wavel))
+            if power < 0 or power > 100:
+                raise ValueError('Power out of range: {}'.format(power))
+            writes = self._wavelength_writes(wavel, delta_wavel_in, nir=(output == 'NIR/IR'))
+            writes.append((self._rf_address, 'b0', "%0.4X" % int(power * 10)))
+            point = SweepPoint(output, wavel, float(power), float(density) if power_density else None)
+            plan.add(point, [(int(dest_add, 16), int(register_in, 16), bytes.fromhex(data_in)[::-1])
+                             for dest_add, register_in, data_in in writes])
+        return plan
+
+    def run_sweep(self, plan, callback=None):
+        '''
+        Run a sweep compiled with compile_sweep. For every point the
+        pre-encoded telegrams are sent and acknowledged, then
+        callback(index, point) is called, e.g. to take a measurement. The
+        callback must not change the wavelength or power itself. The
+        output is switched with set_output where the plan changes it.
+
+        Output: list of (index, dest_add, register_in, data_in, answer)
+            for the writes that were not acknowledged
+        '''
+        failed = []
+        output = self._known_value('output');
+        for i, point in enumerate(plan.points):
+            if point.output != output:
+                self.set_output(point.output)
+                output = point.output
+            for frames, requests in plan.chunks[i]:
+                for request, reply in zip(requests, self._exchange_frames(frames, requests)):
+                    if reply is None or reply.type != telegram.TYPE_ACK:
+                        dest, type, register, data = request
+                        answer = '' if reply is None else reply.hex()
+                        print('Sweep point {}: register {:02X} not set correctly! Answer: {}'.format(i, register, answer))
+                        failed.append((i, '%02X' % dest, '%02X' % register, data[::-1].hex().upper(), answer))
+            self.update_value('wavelength', point.wavelength)
+            self.update_value('power', point.power)
+            if point.power_density is not None:
+                self.update_value('power_density', point.power_density)
+            if callback is not None:
+                callback(i, point)
+        return failed
+
+    def acquire_calibration(self, meter, output, wavelengths, relative_powers=range(0, 101, 5),
+                            filename=None, settle=0.5, n_average=1):
+        '''
+        Measure the power calibration of an output and save it as the
+        calibration file and table used by get_power_calibration.
+
+        The laser steps through every wavelength and, per wavelength,
+        through every relative power with a compiled sweep, and the
+        meter is read after each step. The laser must be emitting; it is
+        left at the last point.
+
+        Input:
+            meter: power meter, see lib.powermeter.PowerMeter (e.g.
+                SimulatedPowerMeter for offline runs)
+            output: 'VIS/NIR' or 'NIR/IR'
+            wavelengths: wavelengths in nm
+            relative_powers: relative powers in %
+            filename: calibration file, defaults to the one configured
+                for the output
+            settle (float): time in s to wait after each step
+            n_average (int): number of meter readings averaged per point
+        Output: CalibrationData
+        '''
+        wavelengths = np.unique(np.asarray(wavelengths, dtype=float))
+        relative_powers = np.unique(np.asarray(relative_powers, dtype=float))
+        if filename is None:
+            if output == 'VIS/NIR':
+                filename = self.vis_calibration_file
+            else:
+                filename = self.ir_calibration_file
+        plan = self.compile_sweep([(output, wavel, rel)
+                                   for wavel in wavelengths for rel in relative_powers])
+        power = np.empty((len(relative_powers), len(wavelengths)))
+
+        def measure(index, point):
+            i_wavel, i_rel = divmod(index, len(relative_powers))
+            if i_rel == 0:
+                meter.set_wavelength(point.wavelength)
+            time.sleep(settle)
+            power[i_rel, i_wavel] = np.mean([meter.read_power() for i in range(n_average)])
+
+        failed = self.run_sweep(plan, measure)
+        if failed:
+            print('Calibration not saved, {} writes not acknowledged'.format(len(failed)))
+            return None
+        data = calibration.CalibrationData(wavelengths,
+            np.repeat(relative_powers[:, None], len(wavelengths), axis=1), power)
+        calibration.save_calibration(filename, data)
+        print('Calibration of {} output written to {}'.format(output, filename))
+        return data
+
     def update(self, type, value):
         if type == 'power_density':
-            rel_power = self.get_power_calibration(value, self.get_wavelength());
+            rel_power = self.get_power_calibration(value, self._known_value('wavelength'));
             self._testvar = 1;
             self.set_power(int(rel_power));
             self._testvar = 0;
@@ -939,7 +1422,7 @@ class SuperK_2014(Instrument):
                 rel_power = self.get_power_calibration(self.get_power_density(), value);
                 self.set_power(rel_power);
             else:  # Relative power is fixed
-                power_density = self.get_power_calibration_inv(self.get_power(), value);
+                power_density = self.get_power_calibration_inv(self._known_value('power'), value);
                 self.set_power_density(power_density);
             self._testvar = 0;
     
@@ -0,0 +1,198 @@
+# bench_calibration.py, speed and accuracy of the SuperK power calibration
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Usage: python benchmarks/bench_calibration.py [n]
+#
+# Writes synthetic calibration files in the SuperK_cal_*.txt format for
+# both outputs and compares, for n random targets:
+#   legacy   the original implementation, parsing the file on every call
+#            and searching a 0.1 % grid of relative powers
+#   exact    parsed once (CalibrationData), exact curve inversion
+#   table    memory-mapped CalibrationTable lookups, as used by the driver,
+#            one target per call and all targets in one call
+# Accuracy is reported as the relative power error of a round trip
+# (relative power -> exact power -> relative power), the power error of
+# the inverse against the exact interpolation, and the difference to the
+# legacy results.
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib import superk_calibration as calibration
+
+# output, wavelength range and step (nm), spot area of the forward
+# and of the inverse calibration (m2), as in SuperK_2014
+OUTPUTS = (
+    ('VIS/NIR', 640, 1100, 2, np.pi * (1e-3) ** 2, np.pi * (1e-3 / 2) ** 2),
+    ('NIR/IR', 1150, 2000, 5, np.pi * (2e-3) ** 2, np.pi * (2e-3 / 2) ** 2),
+)
+RELATIVE_POWERS = np.arange(0, 101, 5)
+
+def write_calibration(filename, wl_min, wl_max, wl_step, seed=0):
+    '''
+    Write a synthetic calibration file: a smooth spectrum times a
+    power law in relative power, plus powermeter offset and noise.
+    '''
+    rng = np.random.default_rng(seed)
+    wavelengths = np.arange(wl_min, wl_max + wl_step / 2.0, wl_step)
+    spectrum = 1 + 0.4 * np.sin((wavelengths - wl_min) / 60.0) \
+        - 0.3 * ((wavelengths - wl_min) / (wl_max - wl_min)) ** 2
+    with open(filename, 'w') as f:
+        f.write('# Wavelength (nm)\tRelative power (%)\tPower (W)\n')
+        for rel in RELATIVE_POWERS:
+            power = 2e-3 * spectrum * (rel / 100.0) ** 1.4 + 3e-8 \
+                + rng.normal(0, 2e-10, len(wavelengths))
+            for wl, p in zip(wavelengths, power):
+                f.write('%g\t%g\t%.6e\n' % (wl, rel, p))
+
+def _legacy_read(filename, cal_area, wavel, offset=False):
+    wavelength_list = []
+    relative_power_list = []
+    absolute_power_list = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if (line[0] != '#') and (len(line) > 5):
+                tmp = line.replace('\n', '').split('\t')
+                wavelength_list.append(float(tmp[0]))
+                relative_power_list.append(float(tmp[1]))
+                absolute_power_list.append(float(tmp[2]) / cal_area)
+    absolute_power_list_arr = np.array(absolute_power_list)
+    if offset:
+        absolute_power_list_arr = absolute_power_list_arr - min(absolute_power_list)
+    rel_power_list = []
+    abs_power_list = []
+    wavelength_list_unique = np.unique(wavelength_list)
+    n_wavel_cal = len(wavelength_list_unique)
+    n_power_cal = int(len(wavelength_list) / n_wavel_cal)
+    for p in range(n_power_cal):
+        rel_power_list.append(np.interp(wavel, wavelength_list_unique,
+            relative_power_list[p * n_wavel_cal:(p + 1) * n_wavel_cal]))
+        abs_power_list.append(np.interp(wavel, wavelength_list_unique,
+            absolute_power_list_arr[p * n_wavel_cal:(p + 1) * n_wavel_cal]))
+    return rel_power_list, abs_power_list
+
+def legacy_forward(filename, cal_area, power_density, wavel):
+    '''SuperK_2014.get_power_calibration before the calibration store.'''
+    rel_power_list, abs_power_list = _legacy_read(filename, cal_area, wavel)
+    fine_rel_power_list = list(np.arange(0, 100, 0.1))
+    fine_abs_power_list = np.interp(fine_rel_power_list, rel_power_list, abs_power_list)
+    tmp = abs(np.array(fine_abs_power_list) - power_density)
+    return fine_rel_power_list[list(tmp).index(min(tmp))]
+
+def legacy_inverse(filename, cal_area, power_relative, wavel):
+    '''SuperK_2014.get_power_calibration_inv before the calibration store.'''
+    rel_power_list, abs_power_list = _legacy_read(filename, cal_area, wavel, offset=True)
+    return np.interp(power_relative, rel_power_list, abs_power_list)
+
+def exact_forward(data, cal_area, power_density, wavel):
+    rel, power = data.at_wavelength(wavel)
+    return calibration.invert_curve(power_density * cal_area, rel, power)[0]
+
+def exact_inverse(data, cal_area, power_relative, wavel):
+    rel, power = data.at_wavelength(wavel)
+    return np.interp(power_relative, rel, power - data.min_power) / cal_area
+
+def exact_powers(data, rel, wavel):
+    '''Exact power (W) for every (relative power, wavelength) pair.'''
+    return np.array([np.interp(r, *data.at_wavelength(w))
+        for r, w in zip(rel, wavel)])
+
+def table_forward(table, cal_area, power_density, wavel):
+    return table.relative_power_at(power_density * cal_area, wavel)
+
+def table_inverse(table, cal_area, power_relative, wavel):
+    return (table.power_at(power_relative, wavel) - table.min_power) / cal_area
+
+def _per_call(func, args):
+    start = time.perf_counter()
+    result = [func(*a) for a in args]
+    return np.array(result, dtype=float), (time.perf_counter() - start) / len(args)
+
+def run(n=10000):
+    rng = np.random.default_rng(1)
+    n_legacy = max(min(n // 50, 200), 1)
+    with tempfile.TemporaryDirectory() as dirname:
+        for seed, (output, wl_min, wl_max, wl_step, area, area_inv) in enumerate(OUTPUTS):
+            filename = os.path.join(dirname, 'SuperK_cal_%d.txt' % seed)
+            write_calibration(filename, wl_min, wl_max, wl_step, seed)
+            start = time.perf_counter()
+            data = calibration.parse_calibration(filename)
+            t_parse = time.perf_counter() - start
+            start = time.perf_counter()
+            calibration.CalibrationTable.build(data).save(filename + '.lut.npy')
+            t_build = time.perf_counter() - start
+            start = time.perf_counter()
+            table = calibration.CalibrationTable.load(filename + '.lut.npy')
+            t_map = time.perf_counter() - start
+
+            print('%s: %d lines, %d wavelengths x %d powers' % (output,
+                data.power.size, len(data.wavelengths), data.power.shape[0]))
+            print('  parse %.1f ms, build table %.1f ms, map table %.3f ms'
+                % (t_parse * 1e3, t_build * 1e3, t_map * 1e3))
+
+            # Targets: relative powers and their exact power densities
+            wavel = rng.uniform(wl_min, wl_max, n)
+            rel = rng.uniform(1, 99, n)
+            power = exact_powers(data, rel, wavel)
+            density = power / area
+
+            # Single point conversions
+            print('  %-8s %12s %12s %16s %16s' % ('', 'fwd us/call',
+                'inv us/call', 'round trip max %', 'inv max rel err'))
+            idx = slice(0, n_legacy)
+            engines = (
+                ('legacy', legacy_forward, legacy_inverse, filename, idx),
+                ('exact', exact_forward, exact_inverse, data, slice(None)),
+                ('table', table_forward, table_inverse, table, slice(None)),
+            )
+            inv_ref = (power - data.min_power) / area_inv
+            results = {}
+            for name, forward, inverse, source, sel in engines:
+                fwd, t_fwd = _per_call(forward, [(source, area, d, w)
+                    for d, w in zip(density[sel], wavel[sel])])
+                inv, t_inv = _per_call(inverse, [(source, area_inv, r, w)
+                    for r, w in zip(rel[sel], wavel[sel])])
+                results[name] = fwd, inv
+                print('  %-8s %12.1f %12.1f %16.4f %16.2e' % (name, t_fwd * 1e6,
+                    t_inv * 1e6, np.max(np.abs(fwd - rel[sel])),
+                    np.max(np.abs(inv - inv_ref[sel]) / inv_ref[sel])))
+
+            # Bulk conversions of all targets in one call, as done by
+            # get_power_calibration_many and get_power_calibration_inv_many
+            start = time.perf_counter()
+            fwd = table_forward(table, area, density, wavel)
+            t_fwd = time.perf_counter() - start
+            start = time.perf_counter()
+            inv = table_inverse(table, area_inv, rel, wavel)
+            t_inv = time.perf_counter() - start
+            print('  bulk table fwd %d targets in %.2f ms (%.2f us/target), round trip max %.4f %%'
+                % (n, t_fwd * 1e3, t_fwd / n * 1e6, np.max(np.abs(fwd - rel))))
+            print('  bulk table inv %d targets in %.2f ms (%.2f us/target), max rel err %.2e'
+                % (n, t_inv * 1e3, t_inv / n * 1e6, np.max(np.abs(inv - inv_ref) / inv_ref)))
+
+            # Agreement with the legacy implementation
+            for name in ('exact', 'table'):
+                fwd, inv = results[name]
+                print('  %s vs legacy: forward max %.3f %%, inverse max rel %.2e' % (name,
+                    np.max(np.abs(fwd[idx] - results['legacy'][0])),
+                    np.max(np.abs(inv[idx] - results['legacy'][1]) / results['legacy'][1])))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,61 @@
+# bench_crc.py, CRC-CCITT (XModem) throughput in frames per second
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Usage: python benchmarks/bench_crc.py [n]
+# crccheck is only needed for the comparison with the old implementation.
+
+import os
+import sys
+import timeit
+from binascii import unhexlify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.crc import crc_xmodem, CrcXmodem
+
+try:
+    from crccheck.crc import CrcXmodem as CrcXmodemCrccheck
+except ImportError:
+    CrcXmodemCrccheck = None
+
+# Telegram bodies: acknowledge, wavelength write, power table block
+FRAMES = (
+    ('ack (4 B)', bytes.fromhex('42060390')),
+    ('write (8 B)', bytes.fromhex('0642059040420f00')),
+    ('table (84 B)', bytes.fromhex('4210089500') + bytes(range(79))),
+)
+
+def legacy_calculate_crc(d_in):
+    tmp = hex(CrcXmodemCrccheck.calc(unhexlify(d_in)))
+    return tmp[0:2] + '0' * (6 - len(tmp)) + tmp[2:]
+
+def run(n=20000):
+    for label, body in FRAMES:
+        body_hex = body.hex()
+        header, payload = body[:4], body[4:]
+        cases = [
+            ('crc_xmodem', lambda: crc_xmodem(body)),
+            ('incremental', lambda: CrcXmodem(header).update(payload).value),
+        ]
+        if CrcXmodemCrccheck is not None:
+            assert CrcXmodemCrccheck.calc(body) == crc_xmodem(body)
+            cases.insert(0, ('crccheck, hex string',
+                lambda: legacy_calculate_crc(body_hex)))
+        for name, func in cases:
+            t = min(timeit.repeat(func, number=n, repeat=5)) / n
+            print('%-13s %-22s %12.0f frames/s' % (label, name, 1.0 / t))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:2]])
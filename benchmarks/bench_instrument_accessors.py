@@ -0,0 +1,199 @@
+# bench_instrument_accessors.py, calls per second of the generated
+# get_<name> / set_<name> functions of Instrument parameters
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Usage: python benchmarks/bench_instrument_accessors.py [n]
+#
+# Compares, with a driver whose do_get/do_set functions do nothing:
+#   legacy     the lambdas add_parameter created before, calling
+#              Instrument.get / Instrument.set with the option checks
+#              and value casting of that time
+#   generic    Instrument.get / Instrument.set as they are now
+#   accessor   the compiled get_<name> / set_<name> accessors
+
+import os
+import sys
+import time
+import logging
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrument
+from instrument import Instrument
+
+OPTIONS = ('VIS/NIR', 'NIR/IR', 'UV/VIS', 'MIR', 'OFF')
+
+class BenchDriver(Instrument):
+    '''Instrument with parameters of the common kinds.'''
+
+    def __init__(self, name):
+        Instrument.__init__(self, name)
+        self.add_parameter('power', type=float, units='%',
+            minval=0, maxval=100)
+        self.add_parameter('cached', type=float, max_age=3600)
+        self.add_parameter('output', type=str, option_list=OPTIONS)
+        self.add_parameter('level', type=float, channels=(1, 2))
+        self._value = 1.0
+        self._output = 'VIS/NIR'
+
+    def do_get_power(self):
+        return self._value
+
+    def do_set_power(self, val):
+        self._value = val
+
+    def do_get_cached(self):
+        return self._value
+
+    def do_set_cached(self, val):
+        self._value = val
+
+    def do_get_output(self):
+        return self._output
+
+    def do_set_output(self, val):
+        self._output = val
+
+    def do_get_level(self, channel):
+        return self._value
+
+    def do_set_level(self, val, channel):
+        self._value = val
+
+def legacy_val_from_option_list(opts, value):
+    if type(opts[0]) is not type(value):
+        return None
+    if isinstance(value, str):
+        value = value.upper()
+
+    match = None
+    matches = 0
+    for val in opts:
+        if isinstance(val, str):
+            val = val.upper()
+            if val.startswith(value):
+                matches += 1
+                match = val.upper()
+
+        if val == value:
+            return val
+
+    if matches == 1:
+        return match
+    else:
+        return None
+
+class LegacyDriver(BenchDriver):
+    '''BenchDriver with the checks and lambdas used before the accessors.'''
+
+    def __init__(self, name):
+        BenchDriver.__init__(self, name)
+        for pname, p in self._parameters.items():
+            self._add_legacy_functions(pname, p.get('channel'))
+
+    def _add_legacy_functions(self, name, ch):
+        if ch is not None:
+            setattr(self, 'get_%s' % name, lambda query=True, **lopts:
+                self.get(name, query=query, channel=ch, **lopts))
+            setattr(self, 'set_%s' % name, lambda val, **lopts:
+                self.set(name, val, channel=ch, **lopts))
+        else:
+            setattr(self, 'get_%s' % name, lambda query=True, **lopts:
+                self.get(name, query=query, **lopts))
+            setattr(self, 'set_%s' % name, lambda val, **lopts:
+                self.set(name, val, **lopts))
+
+    def _store_value(self, p, value):
+        if 'type' in p and value is not None:
+            try:
+                if isinstance(p['type'], int):
+                    value = int(value)
+                elif isinstance(p['type'], float):
+                    value = float(value)
+                elif isinstance(p['type'], str):
+                    pass
+                elif isinstance(p['type'], bool):
+                    value = bool(value)
+                elif isinstance(p['type'], type(None)):
+                    pass
+                elif p['type'] == np.ndarray:
+                    value = np.array(value)
+            except:
+                logging.warning('Unable to cast value "%s" to %s', value, p['type'])
+        p['value'] = value
+        p['value_time'] = time.monotonic()
+        return value
+
+    def _check_set_value(self, name, p, value):
+        if not p['flags'] & Instrument.FLAG_SET:
+            return None
+        if 'format_map' in p:
+            newval = self._val_from_option_dict(p['format_map'], value)
+            if newval is None:
+                return
+            value = newval
+        if 'option_list' in p:
+            newval = legacy_val_from_option_list(p['option_list'], value)
+            if newval is None:
+                return
+            value = newval
+        if 'type' in p:
+            try:
+                value = self._convert_value(value, p['type'])
+            except:
+                return None
+        if 'minval' in p and value < p['minval']:
+            return None
+        if 'maxval' in p and value > p['maxval']:
+            return None
+        return value
+
+CASES = (
+    ('get power', 'get_power', (), 'power', ()),
+    ('get power (stored)', 'get_power', (False,), 'power', (False,)),
+    ('get cached (max_age)', 'get_cached', (), 'cached', ()),
+    ('get level1 (channel)', 'get_level1', (), 'level1', ()),
+    ('set power', 'set_power', (42.0,), 'power', (42.0,)),
+    ('set output', 'set_output', ('nir',), 'output', ('nir',)),
+    ('set level1 (channel)', 'set_level1', (3.0,), 'level1', (3.0,)),
+)
+
+def _rate(func, args, n):
+    return n / min(timeit.repeat(lambda: func(*args), number=n, repeat=3))
+
+def run(n=100000):
+    legacy = LegacyDriver('legacy')
+    compiled = BenchDriver('compiled')
+    print('%-24s %14s %14s %14s %8s' % ('calls/s', 'legacy', 'generic',
+        'accessor', 'speedup'))
+    for label, fname, fargs, pname, pargs in CASES:
+        generic = compiled.set if fname.startswith('set') else compiled.get
+        r_legacy = _rate(getattr(legacy, fname), fargs, n)
+        r_generic = _rate(generic, (pname,) + pargs, n)
+        r_accessor = _rate(getattr(compiled, fname), fargs, n)
+        print('%-24s %14.0f %14.0f %14.0f %7.1fx' % (label, r_legacy,
+            r_generic, r_accessor, r_accessor / r_legacy))
+
+    # Option lookup alone: prefix scan against the compiled dictionary
+    lookup = instrument._compile_option_list(OPTIONS)
+    r_scan = _rate(legacy_val_from_option_list, (OPTIONS, 'nir'), n)
+    r_dict = _rate(lambda v: lookup.get(v.upper()), ('nir',), n)
+    print('%-24s %14.0f %14s %14.0f %7.1fx' % ('option lookup', r_scan, '',
+        r_dict, r_dict / r_scan))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,109 @@
+# bench_superk_telegram.py, compare the byte-level telegram codec with the
+# hex string path SuperK_2014.send_command used before.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Usage: python benchmarks/bench_superk_telegram.py [n]
+# The hex string path uses crccheck like send_command did, or lib.crc if
+# crccheck is not installed.
+
+import os
+import sys
+import timeit
+from binascii import unhexlify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib import superk_telegram as telegram
+
+try:
+    from crccheck.crc import CrcXmodem
+except ImportError:
+    from lib.crc import CrcXmodem
+
+_sot = '0D'
+_eot = '0A'
+_soe = '5E'
+_addVal = 64
+_reserved = (_sot, _eot, _soe, _sot.lower(), _eot.lower(), _soe.lower())
+
+def legacy_calculate_crc(d_in):
+    tmp = hex(CrcXmodem.calc(unhexlify(d_in)))
+    return tmp[0:2] + '0' * (6 - len(tmp)) + tmp[2:]
+
+def legacy_encode(dest_add, host, type_in, register_in, data_in):
+    data_in_end = ''
+    data_in_end_crc = ''
+    for i in reversed(range(0, len(data_in), 2)):
+        if data_in[i:i + 2] in _reserved:
+            data_in_end += _soe + hex(int(data_in[i:i + 2], 16) + _addVal)[2:]
+        else:
+            data_in_end += data_in[i:i + 2]
+        data_in_end_crc += data_in[i:i + 2]
+    crc = legacy_calculate_crc(dest_add + host + type_in + register_in + data_in_end_crc)
+    if crc[2:4] in _reserved:
+        crc = crc[0:2] + (_soe + hex(int(crc[2:4], 16) + _addVal)[2:]) + crc[4:]
+    elif crc[4:] in _reserved:
+        crc = crc[0:4] + (_soe + hex(int(crc[4:], 16) + _addVal)[2:])
+    message = dest_add + host + type_in + register_in + data_in_end
+    return bytes.fromhex(_sot + message + crc[2:] + _eot)
+
+def legacy_decode(answer_hex):
+    answer_hex_filtered = ''
+    special = 0
+    for i in range(0, len(answer_hex), 2):
+        if answer_hex[i:i + 2] == _sot.lower():
+            continue
+        elif answer_hex[i:i + 2] == _eot.lower():
+            crc_ok = CrcXmodem.calc(unhexlify(answer_hex_filtered)) == 0
+        elif answer_hex[i:i + 2] in (_soe, _soe.lower()):
+            special = 1
+        elif special == 1:
+            answer_hex_filtered += ("%0.2x" % (int(answer_hex[i:i + 2], 16) - _addVal))
+            special = 0
+        else:
+            answer_hex_filtered += answer_hex[i:i + 2]
+    data_ordered = ''
+    for i in reversed(range(8, len(answer_hex_filtered) - 4, 2)):
+        data_ordered += answer_hex_filtered[i:i + 2]
+    return answer_hex_filtered[0:8] + data_ordered + answer_hex_filtered[len(answer_hex_filtered) - 4:]
+
+def new_encode(dest_add, host, type_in, register_in, data_in):
+    return telegram.encode(int(dest_add, 16), int(host, 16), int(type_in, 16),
+        int(register_in, 16), bytes.fromhex(data_in)[::-1])
+
+def new_decode(answer):
+    return telegram.decode(answer).hex()
+
+def run(n=20000):
+    # Wavelength write (8 bytes of payload) and its datagram answer
+    args = ('06', '42', '05', '90', '000F4240')
+    reply = telegram.encode(0x42, 0x06, telegram.TYPE_DATAGRAM, 0x90,
+        bytes.fromhex('000D0A5E')[::-1])
+
+    assert legacy_encode(*args) == new_encode(*args)
+    assert legacy_decode(reply.hex()) == new_decode(reply)
+
+    cases = (
+        ('encode, hex string path', lambda: legacy_encode(*args)),
+        ('encode, byte codec', lambda: new_encode(*args)),
+        ('decode, hex string path', lambda: legacy_decode(reply.hex())),
+        ('decode, byte codec', lambda: new_decode(reply)),
+    )
+    for label, func in cases:
+        t = min(timeit.repeat(func, number=n, repeat=5)) / n
+        print('%-26s %8.2f us/telegram' % (label, t * 1e6))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:2]])
@@ -19,11 +19,479 @@ import copy
 import time
 import math
 import inspect
+import bisect
+import threading
+import concurrent.futures
 import lib.calltimer
 import logging
 import numpy as np
 from gettext import gettext as _L
 
+class ChangeBus():
+    '''
+    Delivers parameter changes of instruments to subscribers.
+
+    Publishing only merges the changes into the pending batch of the
+    sending instrument; a dispatcher thread hands the batches to the
+    subscribers. Changes arriving while a batch waits are coalesced into
+    it, the latest value of a parameter winning, so at most one batch
+    per instrument is queued however fast parameters change.
+    '''
+
+    def __init__(self, min_interval=0.02):
+        '''
+        Input:
+            min_interval (float): time in s changes are collected after
+                the first one before they are delivered
+        '''
+        self._min_interval = min_interval
+        self._subscribers = {}
+        self._next_id = 1
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._delivering = False
+        self.delivered = 0
+        self.coalesced = 0
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def subscribe(self, callback, sender=None, args=()):
+        '''
+        Call callback(sender, changed, *args) from the dispatcher thread
+        for every batch of changes, of one instrument or of all.
+
+        Output: subscription id for unsubscribe
+        '''
+        with self._cond:
+            sid = self._next_id
+            self._next_id += 1
+            self._subscribers[sid] = (sender, callback, args)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='change bus')
+                self._thread.daemon = True
+                self._thread.start()
+        return sid
+
+    def unsubscribe(self, sid):
+        with self._cond:
+            self._subscribers.pop(sid, None)
+
+    def publish(self, sender, changed):
+        '''Queue changes (dictionary of parameter -> value) of sender.'''
+        if not self._subscribers:
+            return
+        with self._cond:
+            batch = self._pending.get(sender)
+            if batch is None:
+                self._pending[sender] = dict(changed)
+                self._cond.notify_all()
+            else:
+                self.coalesced += len(changed)
+                batch.update(changed)
+
+    def flush(self, timeout=None):
+        '''
+        Wait until all queued changes are delivered. Called from a
+        subscriber callback, i.e. on the dispatcher thread, it returns
+        False at once since the delivery in progress cannot finish.
+        '''
+        if threading.current_thread() is self._thread:
+            return False
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._pending and not self._delivering, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                self._delivering = True
+            # Let a burst of changes collect into the pending batches
+            time.sleep(self._min_interval)
+            with self._cond:
+                pending = self._pending
+                self._pending = {}
+                subscribers = list(self._subscribers.values())
+            for sender, changed in pending.items():
+                for target, callback, args in subscribers:
+                    if target is None or target is sender:
+                        try:
+                            callback(sender, changed, *args)
+                        except Exception:
+                            logging.exception('Change callback %r failed', callback)
+                self.delivered += 1
+            with self._cond:
+                self._delivering = bool(self._pending)
+                self._cond.notify_all()
+
+# Shared by all instruments in the process
+change_bus = ChangeBus()
+
+class _CallTiming():
+    __slots__ = ('count', 'errors', 'total', 'max', 'histogram')
+
+    def __init__(self, bins):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (bins + 1)
+
+class CallMetrics():
+    '''
+    Optional timing of the driver calls behind parameter gets and sets.
+
+    While enabled, every do_get / do_set call (and do_get_many /
+    do_set_many batch) is counted per instrument and parameter, with its
+    latency in a histogram and the exceptions it raised. Drivers report
+    the bytes they exchange on their bus with Instrument._report_bus.
+    Nested calls are timed separately, so a slow set that gets other
+    parameters shows up with those gets next to it. When disabled, the
+    cost for a call is a single attribute check.
+    '''
+
+    # Upper edges in s of the latency histogram bins; the last bin counts
+    # longer calls
+    LATENCY_BINS = (1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._bus = {}
+        self._log_stop = None
+
+    def enable(self, log_interval=None):
+        '''
+        Start recording.
+
+        Input:
+            log_interval (float): if given, log a summary line every
+                log_interval s until disable()
+        '''
+        self.enabled = True
+        if log_interval is not None and self._log_stop is None:
+            self._log_stop = threading.Event()
+            thread = threading.Thread(target=self._log_loop, name='call metrics',
+                args=(log_interval, self._log_stop))
+            thread.daemon = True
+            thread.start()
+
+    def disable(self):
+        '''Stop recording and logging; the recorded values are kept.'''
+        self.enabled = False
+        if self._log_stop is not None:
+            self._log_stop.set()
+            self._log_stop = None
+
+    def reset(self):
+        with self._lock:
+            self._timings = {}
+            self._bus = {}
+
+    def call(self, ins, name, op, func, *args, **kwargs):
+        '''Call func(*args, **kwargs) and record it as 'op' of ins.name.'''
+        start = time.perf_counter()
+        error = False
+        try:
+            return func(*args, **kwargs)
+        except:
+            error = True
+            raise
+        finally:
+            self.record(ins, name, op, time.perf_counter() - start, error)
+
+    def record(self, ins, name, op, duration, error=False):
+        '''Record a call of 'duration' s.'''
+        key = (ins.get_name(), name, op)
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                timing = self._timings[key] = _CallTiming(len(self.LATENCY_BINS))
+            timing.count += 1
+            timing.total += duration
+            if duration > timing.max:
+                timing.max = duration
+            timing.histogram[bisect.bisect_left(self.LATENCY_BINS, duration)] += 1
+            if error:
+                timing.errors += 1
+
+    def record_bus(self, ins, written, read):
+        '''Record a bus transaction of 'written' and 'read' bytes.'''
+        name = ins.get_name()
+        with self._lock:
+            bus = self._bus.get(name)
+            if bus is None:
+                bus = self._bus[name] = [0, 0, 0]
+            bus[0] += 1
+            bus[1] += written
+            bus[2] += read
+
+    def snapshot(self):
+        '''
+        Return the recorded values as
+        {instrument: {'parameters': {parameter: {op: timing}}, 'bus': bus}}
+        with timing a dictionary of count, errors, total_s, mean_s, max_s
+        and histogram, a list of (upper edge in s or None, count), and bus
+        a dictionary of transactions, bytes_written and bytes_read, for
+        instruments that reported them.
+        '''
+        result = {}
+        edges = self.LATENCY_BINS + (None,)
+        with self._lock:
+            for (ins, name, op), t in self._timings.items():
+                params = result.setdefault(ins, {'parameters': {}})['parameters']
+                params.setdefault(name, {})[op] = {
+                    'count': t.count,
+                    'errors': t.errors,
+                    'total_s': t.total,
+                    'mean_s': t.total / t.count,
+                    'max_s': t.max,
+                    'histogram': list(zip(edges, t.histogram)),
+                }
+            for ins, (transactions, written, read) in self._bus.items():
+                result.setdefault(ins, {'parameters': {}})['bus'] = {
+                    'transactions': transactions,
+                    'bytes_written': written,
+                    'bytes_read': read,
+                }
+        return result
+
+    def format_line(self, top=5):
+        '''
+        Return a one line summary: the 'top' calls with the most total
+        time and the bus traffic per instrument.
+        '''
+        with self._lock:
+            timings = sorted(self._timings.items(), key=lambda kv: -kv[1].total)
+            bus = sorted(self._bus.items())
+        parts = []
+        for (ins, name, op), t in timings[:top]:
+            part = '%s.%s %s %dx %.1f ms avg %.1f ms max' % (ins, name, op,
+                t.count, t.total / t.count * 1e3, t.max * 1e3)
+            if t.errors:
+                part += ' %d errors' % t.errors
+            parts.append(part)
+        for ins, (transactions, written, read) in bus:
+            parts.append('%s bus %d transactions %d B out %d B in' % (ins,
+                transactions, written, read))
+        return 'Call metrics: ' + ('; '.join(parts) if parts else 'no calls')
+
+    def _log_loop(self, interval, stop):
+        while not stop.wait(interval):
+            logging.info(self.format_line())
+
+# Shared by all instruments in the process
+call_metrics = CallMetrics()
+
+def _compile_option_list(opts):
+    '''
+    Compile an option list into a dictionary of accepted value -> option
+    with the matching rules of Instrument._val_from_option_list: string
+    options match case insensitive, exactly or by a prefix no other
+    option starts with, other options only exactly.
+
+    Output: the dictionary, or None if the options cannot be compiled
+        (an empty list or unhashable options)
+    '''
+    if len(opts) == 0:
+        return None
+    lookup = {}
+    counts = {}
+    try:
+        for val in opts:
+            if isinstance(val, str):
+                val = val.upper()
+                for i in range(len(val) + 1):
+                    prefix = val[:i]
+                    counts[prefix] = counts.get(prefix, 0) + 1
+                    lookup[prefix] = val
+        for prefix, count in counts.items():
+            if count > 1:
+                del lookup[prefix]
+        for val in opts:
+            if isinstance(val, str):
+                val = val.upper()
+            lookup[val] = val
+    except TypeError:
+        return None
+    return lookup
+
+class _ParameterAccessor():
+    '''
+    Base of the get_<name> and set_<name> functions add_parameter creates.
+
+    The options of the parameter are compiled into slots, so a call with
+    no extra keyword arguments does only the work the options need and
+    calls the driver directly; other calls, and all calls while the
+    access lock is in use, go through Instrument.get / Instrument.set.
+    compile() has to run again when the options change, which
+    Instrument.set_parameter_options takes care of.
+    '''
+
+    __slots__ = ('_ins', '_name', '_p', '_kwargs')
+
+    def __init__(self, ins, name):
+        self._ins = ins
+        self._name = name
+        self._p = ins._parameters[name]
+        self.compile()
+
+    def compile(self):
+        p = self._p
+        self._kwargs = {'channel': p['channel']} if 'channel' in p else {}
+
+# get_<name>
+class _ParameterGetter(_ParameterAccessor):
+
+    __slots__ = ('__doc__', '_soft', '_array', '_get_func', '_max_age')
+
+    def __init__(self, ins, name, soft=False):
+        self._soft = soft
+        _ParameterAccessor.__init__(self, ins, name)
+
+    def compile(self):
+        _ParameterAccessor.compile(self)
+        p = self._p
+        self._array = p['type'] == np.ndarray
+        self._get_func = p.get('get_func')
+        self._max_age = p.get('max_age')
+
+    def __call__(self, query=True, **lopts):
+        ins = self._ins
+        query = query and not self._soft
+        if lopts or Instrument.USE_ACCESS_LOCK:
+            return ins.get(self._name, query=query, **self._kwargs, **lopts)
+
+        p = self._p
+        if not query:
+            value = p.get('value')
+            if self._array and value is not None:
+                return np.array(value)
+            return value
+
+        max_age = self._max_age
+        if max_age is not None:
+            if 'value' in p and time.monotonic() - p.get('value_time', -max_age - 1) <= max_age:
+                p['cache_hits'] += 1
+                value = p['value']
+                if self._array:
+                    value = np.array(value)
+                ins._queue_changed({self._name: value})
+                return value
+            p['cache_misses'] += 1
+
+        if call_metrics.enabled:
+            value = call_metrics.call(ins, self._name, 'get', self._get_func, **self._kwargs)
+        else:
+            value = self._get_func(**self._kwargs)
+        if self._array and value is not None:
+            try:
+                value = np.array(value)
+            except:
+                logging.warning('Unable to cast value "%s" to %s', value, p['type'])
+        p['value'] = value
+        p['value_time'] = time.monotonic()
+        ins._queue_changed({self._name: value})
+        return value
+
+# set_<name>, also used by Instrument to check values to set
+class _ParameterSetter(_ParameterAccessor):
+
+    __slots__ = ('__doc__', '_set_func', '_direct', '_format_map',
+        '_option_list', '_options', '_option_type', '_type',
+        '_minval', '_maxval')
+
+    def compile(self):
+        _ParameterAccessor.compile(self)
+        p = self._p
+        self._set_func = p.get('set_func')
+        self._direct = p.get('maxstep') is None and \
+            not p['flags'] & Instrument.FLAG_GET_AFTER_SET
+        self._format_map = p.get('format_map')
+        self._option_list = p.get('option_list')
+        if self._option_list is not None:
+            self._options = _compile_option_list(self._option_list)
+            self._option_type = type(self._option_list[0]) if self._options is not None else None
+        else:
+            self._options = None
+            self._option_type = None
+        self._type = p.get('type')
+        self._minval = p.get('minval')
+        self._maxval = p.get('maxval')
+
+    def check(self, value):
+        '''
+        Check a value to set against the compiled options and convert it.
+
+        Output: the value to pass to the driver, or None if it is invalid
+        '''
+        name = self._name
+        if self._format_map is not None:
+            newval = self._ins._val_from_option_dict(self._format_map, value)
+            if newval is None:
+                logging.error('Value %s is not a valid option for "%s", valid options: %r',
+                    value, name, repr(self._format_map))
+                return None
+            value = newval
+
+        if self._option_list is not None:
+            if self._options is None:
+                newval = self._ins._val_from_option_list(self._option_list, value)
+            elif type(value) is not self._option_type:
+                newval = None
+            else:
+                try:
+                    newval = self._options.get(value.upper() \
+                        if isinstance(value, str) else value)
+                except TypeError:
+                    newval = None
+            if newval is None:
+                logging.error('Value %s is not a valid option for "%s", valid: %r',
+                    value, name, repr(self._option_list))
+                return None
+            value = newval
+
+        try:
+            value = self._ins._convert_value(value, self._type)
+        except (ValueError, TypeError):
+            return None
+
+        if self._minval is not None and value < self._minval:
+            print('Trying to set too small value: %s' % value)
+            return None
+
+        if self._maxval is not None and value > self._maxval:
+            print('Trying to set too large value: %s' % value)
+            return None
+
+        return value
+
+    def __call__(self, val, **lopts):
+        ins = self._ins
+        if lopts or not self._direct or Instrument.USE_ACCESS_LOCK:
+            return ins.set(self._name, val, **self._kwargs, **lopts)
+
+        if ins._locked:
+            logging.warning('Trying to set value of locked instrument (%s)',
+                    ins.get_name())
+            return False
+
+        value = self.check(val)
+        if value is None:
+            return False
+        if call_metrics.enabled:
+            call_metrics.call(ins, self._name, 'set', self._set_func, value, **self._kwargs)
+        else:
+            self._set_func(value, **self._kwargs)
+        p = self._p
+        p['value'] = value
+        p['value_time'] = time.monotonic()
+        ins._queue_changed({self._name: value})
+        return True
+
 class Instrument():
     """
     Base class for instruments.
@@ -35,6 +503,8 @@ class Instrument():
     Implement an instrument:
     In __init__ call self.add_variable(<name>, <option dict>)
     Implement _do_get_<variable> and _do_set_<variable> functions
+    Optionally implement do_get_many(names) and do_set_many(values) to
+    get or set several parameters in one bus transaction
     """
 
     # FLAGS are used to to set extra properties on a parameter.
@@ -62,9 +532,6 @@ class Instrument():
         self._initialized = False
         self._locked = False
 
-        self._changed = {}
-        self._changed_hid = None
-
         self._options = kwargs
         if 'tags' not in self._options:
             self._options['tags'] = []
@@ -73,7 +540,8 @@ class Instrument():
         self._parameter_groups = {}
         self._functions = {}
         self._added_methods = []
-        self._probe_ids = []
+        self._getters = {}
+        self._setters = {}
 
         self._default_read_var = None
         self._default_write_var = None
@@ -186,7 +654,7 @@ class Instrument():
                 doc += '    %s\n' % str(fmtval)
         if 'format_map' in options:
             doc += '\n\nAllowed parameters:\n'
-            for fmtkey, fmtval in options['format_map'].iteritems():
+            for fmtkey, fmtval in options['format_map'].items():
                 doc += '    %s or %s\n' % (fmtkey, fmtval)
 
         if doc != '':
@@ -213,14 +681,20 @@ class Instrument():
                 minval, maxval: values for bound checking
                 units (string): units for this parameter
                 maxstep (float): maximum step size when changing parameter
-                stepdelay (float): delay when setting steps (in milliseconds)
+                stepdelay (float): delay when setting steps (in milliseconds);
+                    set() waits for the steps, ramp() takes them in the
+                    background
                 tags (array): tags for this parameter
                 doc (string): documentation string to add to get/set functions
                 format_map (dict): map describing allowed options and the
                     formatted (mostly GUI) representation
                 option_list (array/tuple): allowed options
                 persist (bool): if true load/save values in config file
-                probe_interval (int): interval in ms between automatic gets
+                probe_interval (int): interval in ms between automatic gets,
+                    None or <= 0 for none
+                max_age (float): time in s a value read from or set on the
+                    device stays valid; a 'get' within that time returns
+                    the stored value instead of querying the device
                 listen_to (list of (ins, param) tuples): list of parameters
                     to watch. If any of them changes, execute a get for this
                     parameter. Useful for a parameter that depends on one
@@ -244,6 +718,9 @@ class Instrument():
             options['type'] = type(None)
         if 'tags' not in options:
             options['tags'] = []
+        if options.get('max_age') is not None:
+            options['cache_hits'] = 0
+            options['cache_misses'] = 0
 
         # If defining channels call add_parameter for each channel
         if 'channels' in options:
@@ -278,71 +755,62 @@ class Instrument():
         base_name = kwargs.get('base_name', name)
 
         if options['flags'] & Instrument.FLAG_GET:
-            if ch is not None:
-                func = lambda query=True, **lopts: \
-                    self.get(name, query=query, channel=ch, **lopts)
-            else:
-                func = lambda query=True, **lopts: \
-                    self.get(name, query=query, **lopts)
-
-            self._add_options_to_doc(options)
-            func.__doc__ = 'Get variable %s' % name
-            if 'doc' in options:
-                func.__doc__ += '\n%s' % options['doc']
-
-            setattr(self, 'get_%s' % name,  func)
-            self._added_methods.append('get_%s' % name)
-
             # Set function to do_get_%s or _do_get_%s, whichever is available
             # (if no function specified)
             if 'get_func' not in options:
                 options['get_func'] = getattr(self, 'do_get_%s' % base_name, \
                     getattr(self, '_do_get_%s' % base_name, None))
+            get_doc = None
             if options['get_func'] is not None:
-                if options['get_func'].__doc__ is not None:
-                    func.__doc__ += '\n%s' % options['get_func'].__doc__
+                get_doc = options['get_func'].__doc__
             else:
                 options['get_func'] = lambda *a, **kw: \
                     self._get_not_implemented(base_name)
                 self._get_not_implemented(base_name)
 
-        if options['flags'] & Instrument.FLAG_SOFTGET:
-            if ch is not None:
-                func = lambda query=True, **lopts: \
-                    self.get(name, query=False, channel=ch, **lopts)
-            else:
-                func = lambda query=True, **lopts: \
-                    self.get(name, query=False, **lopts)
+            func = _ParameterGetter(self, name)
+            self._add_options_to_doc(options)
+            func.__doc__ = 'Get variable %s' % name
+            if 'doc' in options:
+                func.__doc__ += '\n%s' % options['doc']
+            if get_doc is not None:
+                func.__doc__ += '\n%s' % get_doc
+
+            setattr(self, 'get_%s' % name,  func)
+            self._getters[name] = func
+            self._added_methods.append('get_%s' % name)
 
+        if options['flags'] & Instrument.FLAG_SOFTGET:
+            func = _ParameterGetter(self, name, soft=True)
             func.__doc__ = 'Get variable %s (internal stored value)' % name
             setattr(self, 'get_%s' % name,  func)
+            self._getters[name] = func
             self._added_methods.append('get_%s' % name)
 
         if options['flags'] & Instrument.FLAG_SET:
-            if ch is not None:
-                func = lambda val, **lopts: self.set(name, val, channel=ch, **lopts)
-            else:
-                func = lambda val, **lopts: self.set(name, val, **lopts)
-
-            func.__doc__ = 'Set variable %s' % name
-            if 'doc' in options:
-                func.__doc__ += '\n%s' % options['doc']
-            setattr(self, 'set_%s' % name, func)
-            self._added_methods.append('set_%s' % name)
-
             # Set function to do_set_%s or _do_set_%s, whichever is available
             # (if no function specified)
             if 'set_func' not in options:
                 options['set_func'] = getattr(self, 'do_set_%s' % base_name, \
                     getattr(self, '_do_set_%s' % base_name, None))
+            set_doc = None
             if options['set_func'] is not None:
-                if options['set_func'].__doc__ is not None:
-                    func.__doc__ += '\n%s' % options['set_func'].__doc__
+                set_doc = options['set_func'].__doc__
             else:
                 options['set_func'] = lambda *a, **kw: \
                     self._set_not_implemented(base_name)
                 self._set_not_implemented(base_name)
 
+            func = _ParameterSetter(self, name)
+            func.__doc__ = 'Set variable %s' % name
+            if 'doc' in options:
+                func.__doc__ += '\n%s' % options['doc']
+            if set_doc is not None:
+                func.__doc__ += '\n%s' % set_doc
+            setattr(self, 'set_%s' % name, func)
+            self._setters[name] = func
+            self._added_methods.append('set_%s' % name)
+
 #        setattr(self, name,
 #            property(lambda: self.get(name), lambda x: self.set(name, x)))
 
@@ -353,9 +821,7 @@ class Instrument():
         #     options['value'] = None
 
         if 'probe_interval' in options:
-            interval = int(options['probe_interval'])
-            # self._probe_ids.append(gobject.timeout_add(interval,
-                # lambda: self.get(name)))
+            self.set_probe_interval(name, options['probe_interval'])
 
         if 'listen_to' in options:
             insset = set([])
@@ -363,7 +829,7 @@ class Instrument():
             for (ins, param) in options['listen_to']:
                 inshids.append(ins.connect('changed', \
                         self._listen_parameter_changed_cb,
-                        param, options['get_func']))
+                        param, name))
             options['listed_hids'] = inshids
 
         if 'group' in options:
@@ -381,11 +847,17 @@ class Instrument():
         object can be garbage collected.
         '''
 
-        for name, opts in self._parameters.iteritems():
+        lib.calltimer.probe_scheduler.remove(self)
+        lib.calltimer.ramp_engine.cancel(self)
+        for name, opts in self._parameters.items():
+            for hid in opts.get('listed_hids', ()):
+                change_bus.unsubscribe(hid)
             for fname in ('get_%s' % name, 'set_%s' % name):
                 if hasattr(self, fname):
                     delattr(self, fname)
         self._parameters = {}
+        self._getters = {}
+        self._setters = {}
 
     def remove_parameter(self, name):
         if name not in self._parameters:
@@ -395,6 +867,12 @@ class Instrument():
             if hasattr(self, func):
                 delattr(self, func)
 
+        lib.calltimer.probe_scheduler.remove(self, name)
+        lib.calltimer.ramp_engine.cancel(self, name)
+        for hid in self._parameters[name].get('listed_hids', ()):
+            change_bus.unsubscribe(hid)
+        self._getters.pop(name, None)
+        self._setters.pop(name, None)
         del self._parameters[name]
         # self.emit('parameter-removed', name)
 
@@ -445,8 +923,16 @@ class Instrument():
             print('Parameter %s not defined' % name)
             return None
 
-        for key, val in kwargs.iteritems():
-            self._parameters[name][key] = val
+        p = self._parameters[name]
+        for key, val in kwargs.items():
+            p[key] = val
+        if p.get('max_age') is not None:
+            p.setdefault('cache_hits', 0)
+            p.setdefault('cache_misses', 0)
+
+        for accessors in (self._getters, self._setters):
+            if name in accessors:
+                accessors[name].compile()
 
         # self.emit('parameter-changed', name)
 
@@ -519,6 +1005,57 @@ class Instrument():
         '''
         self.set_parameter_options(name, maxstep=stepsize, stepdelay=stepdelay)
 
+    def set_probe_interval(self, name, interval):
+        '''
+        Get a parameter automatically in the background.
+
+        Input:
+            name (string): parameter name
+            interval (int): interval in ms between gets, None or <= 0
+                to stop
+        '''
+        if name not in self._parameters:
+            return
+        p = self._parameters[name]
+        if interval is None or interval <= 0:
+            p.pop('probe_interval', None)
+            lib.calltimer.probe_scheduler.remove(self, name)
+            return
+        p['probe_interval'] = int(interval)
+        lib.calltimer.probe_scheduler.add(self, name, int(interval) / 1000.0,
+            self._probe)
+
+    def is_busy(self):
+        '''
+        Return whether the instrument is busy, e.g. with measurement
+        traffic, so background probes should wait. Override in drivers
+        that can tell.
+        '''
+        return False
+
+    def _probe(self, names):
+        '''
+        Get parameters for the probe scheduler. Returns False, without
+        getting anything, if the instrument is busy or its access lock is
+        taken.
+        '''
+        if self.is_busy():
+            return False
+        if Instrument.USE_ACCESS_LOCK:
+            if not self._access_lock.acquire(blocking=False):
+                return False
+        try:
+            # A probe is meant to read the device, not recently stored values
+            for name in names:
+                self._parameters[name].pop('value_time', None)
+            result = self._get_values(names)
+        finally:
+            if Instrument.USE_ACCESS_LOCK:
+                self._access_lock.release()
+        if len(result) > 0:
+            self._queue_changed(result)
+        return True
+
     def get_parameter_names(self):
         '''
         Returns a list of parameter names.
@@ -656,6 +1193,10 @@ class Instrument():
             print('Could not retrieve options for parameter %s' % name)
             return None
 
+        # A get with other arguments than the parameter's own channel
+        # reads something else than the stored value, e.g. another
+        # channel: it bypasses max_age and is not stored
+        plain = self._is_plain_get(p, kwargs)
         if 'channel' in p and 'channel' not in kwargs:
             kwargs['channel'] = p['channel']
 
@@ -675,33 +1216,110 @@ class Instrument():
             print('Instrument does not support getting of %s' % name)
             return None
 
-        if 'base_name' in p:
-            base_name = p['base_name']
-        else:
-            base_name = name
+        max_age = p.get('max_age')
+        if max_age is not None and plain:
+            if 'value' in p and time.monotonic() - p.get('value_time', -max_age - 1) <= max_age:
+                p['cache_hits'] += 1
+                if p['type'] == np.ndarray:
+                    return np.array(p['value'])
+                return p['value']
+            p['cache_misses'] += 1
 
         func = p['get_func']
-        value = func(**kwargs)
-        if 'type' in p and value is not None:
+        if call_metrics.enabled:
+            value = call_metrics.call(self, name, 'get', func, **kwargs)
+        else:
+            value = func(**kwargs)
+        if not plain:
+            return self._cast_value(p, value)
+        return self._store_value(p, value)
+
+    def _is_plain_get(self, p, kwargs):
+        '''
+        Return whether a get with kwargs reads the parameter value itself,
+        i.e. there are no kwargs other than the parameter's own channel.
+        '''
+        for key, val in kwargs.items():
+            if key != 'channel' or 'channel' not in p or val != p['channel']:
+                return False
+        return True
+
+    def _cast_value(self, p, value):
+        '''
+        Cast a value read from the device to the parameter type. Only
+        arrays are cast, other types are returned as the driver gives them.
+        '''
+        if p.get('type') is np.ndarray and value is not None:
             try:
-                if isinstance(p['type'], int): #p['type'] == types.IntType:
-                    value = int(value)
-                elif isinstance(p['type'], float): #p['type'] == types.FloatType:
-                    value = float(value)
-                elif isinstance(p['type'], str): #p['type'] == types.StringType:
-                    pass
-                elif isinstance(p['type'], bool): #p['type'] == types.BooleanType:
-                    value = bool(value)
-                elif isinstance(p['type'], type(None)): #p['type'] == types.NoneType:
-                    pass
-                elif p['type'] == np.ndarray:
-                    value = np.array(value)
+                value = np.array(value)
             except:
                 logging.warning('Unable to cast value "%s" to %s', value, p['type'])
+        return value
 
+    def _store_value(self, p, value):
+        '''
+        Cast a value read from the device to the parameter type and store
+        it as the parameter value.
+        '''
+        value = self._cast_value(p, value)
         p['value'] = value
+        p['value_time'] = time.monotonic()
         return value
 
+    def _needs_query(self, name):
+        '''
+        Return whether getting parameter 'name' with query=True has to
+        query the device, i.e. it is not soft, per channel or cached.
+        '''
+        p = self._parameters.get(name)
+        if p is None or 'channel' in p:
+            return False
+        flags = p['flags']
+        if flags & Instrument.FLAG_SOFTGET or not flags & Instrument.FLAG_GET:
+            return False
+        max_age = p.get('max_age')
+        if max_age is not None and 'value' in p and \
+                time.monotonic() - p.get('value_time', -max_age - 1) <= max_age:
+            return False
+        return True
+
+    def _get_values(self, names, query=True, **kwargs):
+        '''
+        Get several parameter values. If the driver implements
+        do_get_many(names), the parameters that have to be queried are
+        handed to it in one call so it can read them in one bus
+        transaction. do_get_many returns a dictionary of parameter ->
+        value; parameters it leaves out are read one by one.
+
+        Output: dictionary of parameter -> value, without parameters
+            whose value is None
+        '''
+        values = {}
+        do_get_many = getattr(self, 'do_get_many', None)
+        if query and do_get_many is not None and not kwargs:
+            batch = [name for name in names if self._needs_query(name)]
+            if batch:
+                if call_metrics.enabled:
+                    read = call_metrics.call(self, '*', 'get_many', do_get_many, batch)
+                else:
+                    read = do_get_many(batch)
+                for name in batch:
+                    if name in read:
+                        p = self._parameters[name]
+                        if 'cache_misses' in p:
+                            p['cache_misses'] += 1
+                        values[name] = self._store_value(p, read[name])
+
+        result = {}
+        for name in names:
+            if name in values:
+                val = values[name]
+            else:
+                val = self._get_value(name, query, **kwargs)
+            if val is not None:
+                result[name] = val
+        return result
+
     def get(self, name, query=True, fast=False, **kwargs):
         '''
         Get one or more Instrument parameter values.
@@ -730,17 +1348,17 @@ class Instrument():
             return ret
 
         if isinstance(name, (list, tuple)): #type(name) in (types.ListType, types.TupleType):
-            changed = {}
-            result = {}
-            for key in name:
-                val = self._get_value(key, query, **kwargs)
-                if val is not None:
-                    result[key] = val
-                    changed[key] = val
+            result = self._get_values(name, query, **kwargs)
+            changed = dict((key, val) for key, val in result.items()
+                           if self._is_plain_get(self._parameters[key], kwargs))
 
         else:
             result = self._get_value(name, query, **kwargs)
-            changed = {name: result}
+            p = self._parameters.get(name)
+            if p is None or self._is_plain_get(p, kwargs):
+                changed = {name: result}
+            else:
+                changed = {}
 
         if Instrument.USE_ACCESS_LOCK:
             self._access_lock.release()
@@ -772,12 +1390,6 @@ class Instrument():
 
         # return thread.get_return_value()
 
-    def _key_from_format_map_val(self, dic, value):
-        for key, val in dic.iteritems():
-            if val == value:
-                return key
-        return None
-
     def _val_from_option_list(self, opts, value):
         if type(opts[0]) is not type(value):
             return None
@@ -812,7 +1424,7 @@ class Instrument():
         except:
             pass
 
-        for k, v in opts.iteritems():
+        for k, v in opts.items():
             if v == value:
                 return k
         return None
@@ -848,6 +1460,61 @@ class Instrument():
 
         return value
 
+    def _check_set_value(self, name, p, value):
+        '''
+        Check a value to set against the options of parameter 'name' and
+        convert it, with the options compiled into its set_<name>.
+
+        Output: the value to pass to the driver, or None if it is invalid
+        '''
+        setter = self._setters.get(name)
+        if setter is None or not p['flags'] & Instrument.FLAG_SET:
+            print('Instrument does not support setting of %s' % name)
+            return None
+        return setter.check(value)
+
+    def _set_values(self, values, **kwargs):
+        '''
+        Set several parameter values. If the driver implements
+        do_set_many(values), the checked values of all parameters without
+        channel, maxstep or FLAG_GET_AFTER_SET are handed to it in one
+        call so it can write them in one bus transaction. do_set_many
+        returns the names of the parameters it has set; the others are
+        set one by one.
+
+        Output: dictionary of parameter -> value set, or None if setting
+            it failed
+        '''
+        results = {}
+        do_set_many = getattr(self, 'do_set_many', None)
+        if do_set_many is not None and not kwargs:
+            batch = {}
+            for name, value in values.items():
+                p = self._parameters.get(name)
+                if p is None or 'channel' in p or p.get('maxstep') is not None \
+                        or p['flags'] & Instrument.FLAG_GET_AFTER_SET:
+                    continue
+                value = self._check_set_value(name, p, value)
+                if value is None:
+                    results[name] = None
+                else:
+                    batch[name] = value
+            if batch:
+                if call_metrics.enabled:
+                    done = call_metrics.call(self, '*', 'set_many', do_set_many, batch)
+                else:
+                    done = do_set_many(batch)
+                for name in done or ():
+                    p = self._parameters[name]
+                    p['value'] = batch[name]
+                    p['value_time'] = time.monotonic()
+                    results[name] = batch[name]
+
+        for name, value in values.items():
+            if name not in results:
+                results[name] = self._set_value(name, value, **kwargs)
+        return results
+
     def _set_value(self, name, value, **kwargs):
         '''
         Private wrapper function to set a value.
@@ -864,93 +1531,178 @@ class Instrument():
         else:
             return None
 
-        if not p['flags'] & Instrument.FLAG_SET:
-            print('Instrument does not support setting of %s' % name)
-            return None
-
         if 'channel' in p and 'channel' not in kwargs:
             kwargs['channel'] = p['channel']
 
-        # If a format map is available the key should be found.
-        if 'format_map' in p:
-            newval = self._val_from_option_dict(p['format_map'], value)
-            if newval is None:
-                logging.error('Value %s is not a valid option for "%s", valid options: %r',
-                    value, name, repr(p['format_map']))
-                return
-            value = newval
-
-        # If an option list is available check whether the value is in there
-        if 'option_list' in p:
-            newval = self._val_from_option_list(p['option_list'], value)
-            if newval is None:
-                logging.error('Value %s is not a valid option for "%s", valid: %r',
-                    value, name, repr(p['option_list']))
-                return
-            value = newval
+        value = self._check_set_value(name, p, value)
+        if value is None:
+            return None
 
-        if 'type' in p:
+        if 'maxstep' in p and p['maxstep'] is not None:
+            future = self._start_ramp(name, p, value, kwargs)
+            # The steps take the access lock on the ramp thread, so it
+            # must not be held while waiting for them
+            held = self._access_lock.release_all() if Instrument.USE_ACCESS_LOCK else 0
             try:
-                value = self._convert_value(value, p['type'])
-            except:
+                return future.result()
+            except concurrent.futures.CancelledError:
+                logging.warning('Ramp of %s was cancelled', name)
                 return None
+            finally:
+                self._access_lock.reacquire(held)
 
-        if 'minval' in p and value < p['minval']:
-            print('Trying to set too small value: %s' % value)
-            return None
+        self._call_set_func(name, p, value, kwargs)
+        return self._finish_set(name, p, value, kwargs)
 
-        if 'maxval' in p and value > p['maxval']:
-            print('Trying to set too large value: %s' % value)
-            return None
+    def _call_set_func(self, name, p, value, kwargs):
+        if call_metrics.enabled:
+            call_metrics.call(self, name, 'set', p['set_func'], value, **kwargs)
+        else:
+            p['set_func'](value, **kwargs)
+
+    def _finish_set(self, name, p, value, kwargs):
+        if p['flags'] & self.FLAG_GET_AFTER_SET:
+            value = self._get_value(name, **kwargs)
+
+        # if p['flags'] & self.FLAG_PERSIST:
+        #     config.set('persist_%s_%s' % (self._name, name), value)
+        #     config.save()
+
+        p['value'] = value
+        p['value_time'] = time.monotonic()
+        return value
+
+    def _ramp_values(self, p, value):
+        '''
+        Return the steps of at most maxstep from the current value of a
+        parameter to 'value'.
+        '''
+        curval = p.get('value')
+        if curval is None:
+            logging.warning('Current value not available, ignoring maxstep')
+            curval = value + 0.01 * p['maxstep']
 
-        if 'base_name' in p:
-            base_name = p['base_name']
+        delta = curval - value
+        if delta < 0:
+            sign = 1
         else:
-            base_name = name
+            sign = -1
 
-        func = p['set_func']
-        if 'maxstep' in p and p['maxstep'] is not None:
-            curval = p['value']
-            if curval is None:
-                logging.warning('Current value not available, ignoring maxstep')
-                curval = value + 0.01 * p['maxstep']
-
-            delta = curval - value
-            if delta < 0:
-                sign = 1
+        values = []
+        while math.fabs(delta) > 0:
+            if math.fabs(delta) > p['maxstep']:
+                curval += sign * p['maxstep']
+                delta += sign * p['maxstep']
             else:
-                sign = -1
+                curval = value
+                delta = 0
+            values.append(curval)
+        return values
 
-            if 'stepdelay' in p:
-                delay = p['stepdelay']
-            else:
-                delay = 50
+    def _start_ramp(self, name, p, value, kwargs):
+        '''
+        Start ramping a checked value on the ramp engine. The stored value
+        follows the steps, so a ramp started while another one runs
+        continues from where that one was cancelled.
+        '''
+        def step(val):
+            self._call_set_func(name, p, val, kwargs)
+            p['value'] = val
+            p['value_time'] = time.monotonic()
 
-            while math.fabs(delta) > 0:
-                if math.fabs(delta) > p['maxstep']:
-                    curval += sign * p['maxstep']
-                    delta += sign * p['maxstep']
-                else:
-                    curval = value
-                    delta = 0
+        delay = p.get('stepdelay', 50)
+        return lib.calltimer.ramp_engine.start(self, name,
+            lambda: self._ramp_values(p, value), delay / 1000.0,
+            lambda val: self._with_access_lock(step, val),
+            lambda: self._with_access_lock(self._finish_set, name, p, value, kwargs))
+
+    def _with_access_lock(self, func, *args):
+        '''
+        Call func(*args) holding the access lock if it is in use, for
+        driver calls made from other threads, e.g. ramp steps.
+        '''
+        if not Instrument.USE_ACCESS_LOCK:
+            return func(*args)
+        if not self._access_lock.acquire():
+            raise RuntimeError('Failed to acquire lock of %s' % self.get_name())
+        try:
+            return func(*args)
+        finally:
+            self._access_lock.release()
 
-                ret = func(curval, **kwargs)
+    def ramp(self, name, value, **kwargs):
+        '''
+        Set a parameter in the background. A parameter with maxstep is
+        ramped in steps of at most maxstep, stepdelay ms apart, without
+        blocking the caller; several parameters, also of different
+        instruments, can ramp at the same time. Ramping a parameter that
+        is still ramping cancels the running ramp.
+
+        Input:
+            name (string): parameter name
+            value (any): the value to ramp to
+            kwargs: Optional keyword args that will be passed on.
+        Output: concurrent.futures.Future with the value set, or None if
+            the value cannot be set. Call result() to wait for the ramp
+            and cancel() to stop it.
+        '''
+        if self._locked:
+            logging.warning('Trying to set value of locked instrument (%s)',
+                    self.get_name())
+            return None
+        if name not in self._parameters:
+            return None
+
+        if Instrument.USE_ACCESS_LOCK:
+            if not self._access_lock.acquire():
+                logging.warning(_L('Failed to acquire lock!'))
+                return None
+        try:
+            future = self._ramp(name, value, kwargs)
+        finally:
+            if Instrument.USE_ACCESS_LOCK:
+                self._access_lock.release()
+        if future is None:
+            return None
+
+        def done(f):
+            if not f.cancelled() and f.exception() is None:
+                self._queue_changed({name: f.result()})
+        future.add_done_callback(done)
+        return future
+
+    def _ramp(self, name, value, kwargs):
+        p = self._parameters[name]
+
+        if 'channel' in p and 'channel' not in kwargs:
+            kwargs['channel'] = p['channel']
 
-                if delta != 0:
-                    time.sleep(delay / 1000.0)
+        value = self._check_set_value(name, p, value)
+        if value is None:
+            return None
 
+        if p.get('maxstep') is not None:
+            future = self._start_ramp(name, p, value, kwargs)
         else:
-            ret = func(value, **kwargs)
+            future = concurrent.futures.Future()
+            try:
+                self._call_set_func(name, p, value, kwargs)
+                future.set_result(self._finish_set(name, p, value, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        return future
 
-        if p['flags'] & self.FLAG_GET_AFTER_SET:
-            value = self._get_value(name, **kwargs)
+    def cancel_ramps(self, name=None):
+        '''Stop the ramp of a parameter, or all ramps of the instrument.'''
+        lib.calltimer.ramp_engine.cancel(self, name)
 
-        # if p['flags'] & self.FLAG_PERSIST:
-        #     config.set('persist_%s_%s' % (self._name, name), value)
-        #     config.save()
+    def wait_ramps(self, timeout=None):
+        '''
+        Wait until all ramps of the instrument are finished.
 
-        p['value'] = value
-        return value
+        Output: True if they finished within the timeout
+        '''
+        return lib.calltimer.ramp_engine.wait(self, timeout)
 
     def set(self, name, value=None, fast=False, **kwargs):
         '''
@@ -984,8 +1736,7 @@ class Instrument():
         result = True
         changed = {}
         if isinstance(name, dict): #type(name) == types.DictType:
-            for key, val in name.iteritems():
-                val = self._set_value(key, val, **kwargs)
+            for key, val in self._set_values(name, **kwargs).items():
                 if val is not None:
                     changed[key] = val
                 else:
@@ -1019,8 +1770,34 @@ class Instrument():
             return None
 
         p['value'] = value
+        p['value_time'] = time.monotonic()
         self._queue_changed({name: value})
 
+    def invalidate_cache(self, name=None):
+        '''
+        Mark the stored value of a parameter, or of all parameters, as
+        outdated, so the next 'get' queries the device even if the
+        parameter has a max_age.
+        '''
+        if name is None:
+            params = self._parameters.values()
+        elif name in self._parameters:
+            params = (self._parameters[name],)
+        else:
+            return
+        for p in params:
+            p.pop('value_time', None)
+
+    def get_cache_stats(self):
+        '''
+        Return the number of gets served from the stored value (hits) and
+        from the device (misses) for every parameter with a max_age.
+
+        Output: dictionary of parameter -> {'hits': int, 'misses': int}
+        '''
+        return dict((name, {'hits': p['cache_hits'], 'misses': p['cache_misses']})
+                    for name, p in self._parameters.items() if 'cache_hits' in p)
+
     def get_argspec_dict(self, a):
         return dict(args=a[0], varargs=a[1], keywords=a[2], defaults=a[3])
 
@@ -1113,6 +1890,13 @@ class Instrument():
         '''
         self._locked = False
 
+    def get_access_lock_stats(self):
+        '''
+        Return the contention statistics of the access lock, shared by
+        all instruments of the same lock class (see TimedLock.get_stats).
+        '''
+        return self._access_lock.get_stats()
+
     def set_default_read_var(self, name):
         '''
         For future use.
@@ -1154,25 +1938,42 @@ class Instrument():
             (Instrument.get_type(self), name))
 
     def _listen_parameter_changed_cb(self, sender, changed, \
-            listen_param, update_func):
+            listen_param, name):
 
         if listen_param not in changed:
             return
 
-        update_func()
+        self.get(name)
 
-    def _do_emit_changed(self):
-        # was this a bug?
-        # self.emit('changed', self._changed)
-        self._changed = {}
-        self._changed_hid = None
+    def connect(self, signal, callback, *args):
+        '''
+        Call callback(instrument, changed, *args) with the dictionary of
+        changed parameter values after parameters of this instrument
+        change. Callbacks run on the change bus dispatcher thread.
+
+        Input:
+            signal (string): only 'changed' is supported
+        Output: handler id for disconnect
+        '''
+        if signal != 'changed':
+            raise ValueError('Unknown signal %s' % signal)
+        return change_bus.subscribe(callback, self, args)
+
+    def disconnect(self, hid):
+        change_bus.unsubscribe(hid)
 
     def _queue_changed(self, changed):
-        self._changed.update(changed)
-        if self._changed_hid is None:
-            # self._changed_hid = gobject.idle_add(self._do_emit_changed)
-            a=1
-            
+        change_bus.publish(self, changed)
+
+    def _report_bus(self, written, read):
+        '''
+        Report a bus transaction of 'written' and 'read' bytes to
+        call_metrics. Drivers call this after their I/O.
+        '''
+        if call_metrics.enabled:
+            call_metrics.record_bus(self, written, read)
+
+
 class InvalidInstrument(Instrument):
     '''
     Placeholder class for instruments that fail to load, mainly to support
@@ -0,0 +1,115 @@
+# asynctransport.py, run blocking instrument I/O from asyncio code
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import collections
+import logging
+import threading
+
+class AsyncTransport():
+    '''
+    Request queue for one instrument bus.
+
+    Requests are callables doing blocking (visa) I/O. They are executed
+    one at a time, in submission order, on a worker thread owned by the
+    transport, while the awaiting coroutine and the rest of the event
+    loop keep running. Several instruments on different buses each get
+    their own transport and make progress at the same time.
+
+    Usage:
+    transport = AsyncTransport('SuperK')
+    answer = await transport.submit(ins.send_command, '06', '04', '90', '')
+    '''
+
+    def __init__(self, name='transport', lock=None):
+        '''
+        Input:
+            name (string): name of the worker thread
+            lock: optional lock held while a request executes, e.g. the
+                lock protecting the bus against synchronous callers
+        '''
+        self._name = name
+        self._lock = lock
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name=self._name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pending(self):
+        '''Return the number of queued requests.'''
+        with self._cond:
+            return len(self._queue)
+
+    async def submit(self, func, *args, **kwargs):
+        '''
+        Queue func(*args, **kwargs) and wait for its result.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Transport %s is closed' % self._name)
+            if self._thread is None:
+                self._start()
+            self._queue.append((loop, future, func, args, kwargs))
+            self._cond.notify()
+        return await future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                loop, future, func, args, kwargs = self._queue.popleft()
+
+            if future.cancelled():
+                continue
+            try:
+                if self._lock is not None:
+                    with self._lock:
+                        result = func(*args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+            except BaseException as e:
+                loop.call_soon_threadsafe(_set_exception, future, e)
+            else:
+                loop.call_soon_threadsafe(_set_result, future, result)
+
+    def close(self):
+        '''
+        Stop accepting requests; queued requests are still executed.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        logging.debug('Transport %s closed', self._name)
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
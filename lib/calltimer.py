@@ -16,27 +16,446 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 
+import bisect
+import collections
+import logging
 import threading
 import time
+import concurrent.futures
 
 
 
 
 class TimedLock():
+    '''
+    Lock handed out first come, first served, with a timeout.
+
+    Waiting threads queue up and sleep on a condition of their own until
+    the lock is released to them, so an acquire takes the lock as soon as
+    it is free and a thread cannot take it before others that were
+    waiting longer. The holder can acquire the lock again, e.g. when a
+    driver gets a parameter while setting another; it has to release it
+    as often. The lock keeps contention statistics, see get_stats, and
+    can be used as a context manager.
+    '''
+
+    # Upper edges in s of the wait time histogram bins; the last bin
+    # counts longer waits
+    WAIT_BINS = (1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
     def __init__(self, delay=1.0):
+        '''
+        Input:
+            delay (float): default timeout of acquire in s
+        '''
         self._lock = threading.Lock()
         self._delay = delay
-
-    def acquire(self):
-        n = int(self._delay / 0.01)
-        for i in range(n):
-            if self._lock.acquire(False):
+        self._waiters = collections.deque()
+        self._holder = None
+        self._count = 0
+        self._held_since = None
+        self._acquired = 0
+        self._contended = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._histogram = [0] * (len(self.WAIT_BINS) + 1)
+
+    def acquire(self, blocking=True, timeout=None):
+        '''
+        Input:
+            blocking (bool): wait for the lock if it is taken
+            timeout (float): time in s to wait; the delay given to the
+                constructor if None, no limit if negative (e.g. -1, as
+                for threading.Lock)
+        Output: True if the lock was acquired
+        '''
+        with self._lock:
+            if self._holder is not None and self._holder[1] == threading.get_ident():
+                self._count += 1
+                return True
+            if self._holder is None and not self._waiters:
+                self._take(0.0)
                 return True
-            time.sleep(0.01)
-        return False
+            if not blocking:
+                return False
+
+            start = time.monotonic()
+            if timeout is None:
+                timeout = self._delay
+            deadline = start + timeout if timeout >= 0 else None
+            waiter = threading.Condition(self._lock)
+            self._waiters.append(waiter)
+            self._contended += 1
+            while self._holder is not None or self._waiters[0] is not waiter:
+                if deadline is None:
+                    waiter.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    first = self._waiters[0] is waiter
+                    self._waiters.remove(waiter)
+                    self._timeouts += 1
+                    # The next waiter may be able to take the lock now
+                    if first and self._holder is None and self._waiters:
+                        self._waiters[0].notify()
+                    return False
+                waiter.wait(remaining)
+            self._waiters.popleft()
+            self._take(time.monotonic() - start)
+            return True
+
+    def _take(self, wait):
+        thread = threading.current_thread()
+        self._holder = (thread.name, thread.ident)
+        self._count = 1
+        self._held_since = time.monotonic()
+        self._acquired += 1
+        self._wait_total += wait
+        if wait > self._wait_max:
+            self._wait_max = wait
+        self._histogram[bisect.bisect_left(self.WAIT_BINS, wait)] += 1
 
     def release(self):
-        self._lock.release()
+        with self._lock:
+            if self._holder is None or self._holder[1] != threading.get_ident():
+                raise RuntimeError('cannot release un-acquired lock')
+            self._count -= 1
+            if self._count > 0:
+                return
+            self._holder = None
+            self._held_since = None
+            if self._waiters:
+                self._waiters[0].notify()
+
+    def locked(self):
+        return self._holder is not None
+
+    def release_all(self):
+        '''
+        Release the lock completely if the calling thread holds it, e.g.
+        to wait for another thread that needs it.
+
+        Output: the number of times it was held, for reacquire
+        '''
+        with self._lock:
+            if self._holder is None or self._holder[1] != threading.get_ident():
+                return 0
+            count = self._count
+            self._count = 1
+        self.release()
+        return count
+
+    def reacquire(self, count):
+        '''Take the lock back after release_all, waiting as long as needed.'''
+        if count > 0:
+            self.acquire(timeout=-1)
+            with self._lock:
+                self._count = count
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TimeoutError('Timeout waiting for lock held by %s'
+                % (self._holder or ('nobody',))[0])
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def get_stats(self):
+        '''
+        Return contention statistics:
+            acquired: number of acquires
+            contended: acquires that had to wait
+            timeouts: acquires that timed out
+            wait_mean, wait_max: wait time in s of the acquires
+            wait_histogram: list of (upper edge in s or None, count)
+            holder: (thread name, thread id) of the holder or None
+            held_for: time in s the holder holds the lock
+            waiting: number of waiting threads
+        '''
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'acquired': self._acquired,
+                'contended': self._contended,
+                'timeouts': self._timeouts,
+                'wait_mean': self._wait_total / self._acquired if self._acquired else 0.0,
+                'wait_max': self._wait_max,
+                'wait_histogram': list(zip(self.WAIT_BINS + (None,), self._histogram)),
+                'holder': self._holder,
+                'held_for': now - self._held_since if self._held_since is not None else 0.0,
+                'waiting': len(self._waiters),
+            }
+
+class _Probe():
+    __slots__ = ('group', 'name', 'interval', 'callback', 'due', 'busy_count')
+
+    def __init__(self, group, name, interval, callback, due):
+        self.group = group
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.due = due
+        self.busy_count = 0
+
+class ProbeScheduler():
+    '''
+    Call probes at regular intervals on a background thread.
+
+    A probe is identified by a group (e.g. an instrument) and a name
+    (e.g. a parameter). Probes of the same group that are due within
+    'coalesce' times their interval are combined into a single
+    callback(names) call, so one bus transaction can serve all of them.
+
+    The callback returns False if the group is busy, e.g. its bus is
+    used by measurement traffic. The probes are then retried after a
+    delay that doubles with every busy result, up to their interval.
+    '''
+
+    def __init__(self, coalesce=0.25, min_retry=0.02):
+        '''
+        Input:
+            coalesce (float): fraction of the interval a probe may be
+                taken early to combine it with another probe of its group
+            min_retry (float): first retry delay in s after a busy result
+        '''
+        self._coalesce = coalesce
+        self._min_retry = min_retry
+        self._probes = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, group, name, interval, callback):
+        '''
+        Add or replace the probe (group, name).
+
+        Input:
+            interval (float): time between probes in s, > 0
+            callback (function): callback(names) with the names of the
+                probes of the group that are due
+        '''
+        if not interval > 0:
+            raise ValueError('Probe interval must be > 0, not %r' % interval)
+        with self._cond:
+            self._probes[(group, name)] = _Probe(group, name, interval,
+                callback, time.monotonic() + interval)
+            self._stopped = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='probe scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def remove(self, group, name=None):
+        '''Remove one probe, or all probes of a group.'''
+        with self._cond:
+            for key in list(self._probes):
+                if key[0] is group and (name is None or key[1] == name):
+                    del self._probes[key]
+            self._cond.notify()
+
+    def get_probes(self, group):
+        '''Return {name: interval} of the probes of a group.'''
+        with self._cond:
+            return dict((p.name, p.interval) for p in self._probes.values()
+                        if p.group is group)
+
+    def stop(self):
+        '''Stop the scheduler thread; probes added later restart it.'''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _next_batch(self):
+        '''
+        Wait for the first due probe and return it with the probes of
+        its group that can be coalesced with it, or None when stopped.
+        '''
+        with self._cond:
+            while True:
+                if self._stopped:
+                    self._thread = None
+                    return None
+                now = time.monotonic()
+                first = min(self._probes.values(), key=lambda p: p.due, default=None)
+                if first is None:
+                    self._cond.wait()
+                elif first.due > now:
+                    self._cond.wait(first.due - now)
+                else:
+                    return [p for p in self._probes.values() if p.group is first.group
+                            and p.due <= now + self._coalesce * p.interval]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                done = batch[0].callback([p.name for p in batch]) is not False
+            except Exception:
+                logging.exception('Probe of %s failed', [p.name for p in batch])
+                done = True
+            now = time.monotonic()
+            with self._cond:
+                for p in batch:
+                    if done:
+                        p.busy_count = 0
+                        # Keep the probe on its grid, unless it fell behind
+                        p.due += p.interval
+                        if p.due <= now:
+                            p.due = now + p.interval
+                    else:
+                        retry = self._min_retry * 2 ** p.busy_count
+                        p.busy_count += 1
+                        p.due = now + min(retry, p.interval)
+
+# Shared by all instruments in the process
+probe_scheduler = ProbeScheduler()
+
+class _Ramp():
+    '''
+    Steps of one ramp, taken on a thread of their own so ramps of
+    different parameters and instruments do not wait for each other.
+    '''
+
+    def __init__(self, values, delay, step, finish, previous=None):
+        self.future = concurrent.futures.Future()
+        self._values = values
+        self._previous = previous
+        self._thread = None
+        self._delay = delay
+        self._step = step
+        self._finish = finish
+        self._wake = threading.Event()
+        self.future.add_done_callback(lambda f: self._wake.set())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ramp')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        future = self.future
+        try:
+            # Let the ramp this one replaces finish its current step
+            if self._previous is not None:
+                self._previous.join()
+                self._previous = None
+            values = self._values
+            if callable(values):
+                values = values()
+            val = None
+            due = time.monotonic()
+            for i, val in enumerate(values):
+                if i > 0:
+                    # Wait for the deadline of this step, wake up early
+                    # if the ramp is cancelled
+                    self._wake.wait(max(due - time.monotonic(), 0))
+                if future.cancelled():
+                    return
+                self._step(val)
+                # Keep the steps on their grid, unless the ramp fell behind
+                due += self._delay
+                now = time.monotonic()
+                if due <= now:
+                    due = now + self._delay
+            result = self._finish() if self._finish is not None else val
+        except Exception as e:
+            try:
+                future.set_exception(e)
+            except concurrent.futures.InvalidStateError:
+                logging.exception('Cancelled ramp failed')
+            return
+        try:
+            future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+class RampEngine():
+    '''
+    Run ramps, series of values set with a fixed delay between them, in
+    the background.
+
+    Step i of a ramp is taken at start + i * delay, so the timing does
+    not drift with the time the steps take. Like probes, a ramp is
+    identified by a group (e.g. an instrument) and a name (e.g. a
+    parameter); starting a ramp cancels the running ramp with the same
+    key. Every ramp runs on its own thread, so any number of ramps can
+    run at the same time.
+    '''
+
+    def __init__(self):
+        self._ramps = {}
+        self._lock = threading.Lock()
+
+    def start(self, group, name, values, delay, step, finish=None):
+        '''
+        Start a ramp.
+
+        Input:
+            values (list): the values of the steps, or a function
+                returning them, called on the thread of the ramp once
+                the ramp it replaces has stopped
+            delay (float): time between steps in s
+            step (function): step(value), takes one step
+            finish (function): finish(), called after the last step; its
+                return value is the result of the ramp. Without it the
+                result is the last value.
+        Output: concurrent.futures.Future of the ramp. Wait for it with
+            result(timeout) or stop the ramp with cancel().
+        '''
+        key = (group, name)
+        with self._lock:
+            old = self._ramps.pop(key, None)
+            ramp = _Ramp(values, delay, step, finish, old)
+            self._ramps[key] = ramp
+        if old is not None:
+            old.future.cancel()
+        ramp.future.add_done_callback(lambda f: self._done(key, ramp))
+        ramp.start()
+        return ramp.future
+
+    def _done(self, key, ramp):
+        with self._lock:
+            if self._ramps.get(key) is ramp:
+                del self._ramps[key]
+
+    def get_ramps(self, group):
+        '''Return {name: future} of the running ramps of a group.'''
+        with self._lock:
+            return dict((key[1], ramp.future) for key, ramp in self._ramps.items()
+                        if key[0] is group)
+
+    def cancel(self, group, name=None):
+        '''Cancel one ramp, or all ramps of a group.'''
+        for ramp_name, future in self.get_ramps(group).items():
+            if name is None or ramp_name == name:
+                future.cancel()
+
+    def wait(self, group=None, timeout=None):
+        '''
+        Wait until the ramps of a group, or all ramps, are finished.
+
+        Output: True if they finished within the timeout
+        '''
+        with self._lock:
+            futures = [ramp.future for key, ramp in self._ramps.items()
+                       if group is None or key[0] is group]
+        not_done = concurrent.futures.wait(futures, timeout)[1]
+        return len(not_done) == 0
+
+# Shared by all instruments in the process
+ramp_engine = RampEngine()
 
 # class ThreadVariable():
 #     def __init__(self, value=None):
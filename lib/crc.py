@@ -0,0 +1,70 @@
+# crc.py, CRC-CCITT (XModem) on bytes
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+CRC-CCITT with the XModem parameters (polynomial 0x1021, initial value 0,
+no reflection, no final xor). binascii.crc_hqx implements exactly this
+CRC with a 256 entry lookup table in C, so there is no need for the
+crccheck package.
+
+Appending the CRC (MSB first) to the data gives a CRC of 0 over the whole,
+which is how received telegrams are checked.
+'''
+
+from binascii import crc_hqx
+
+def crc_xmodem(data, crc=0):
+    '''
+    Return the CRC of data, continuing from a previous value 'crc'.
+
+    Input:
+        data (bytes-like)
+        crc (int): CRC of the preceding bytes, 0 to start
+    Output: CRC (int)
+    '''
+    return crc_hqx(data, crc)
+
+class CrcXmodem():
+    '''
+    Incremental CRC, for frames that are built or received in pieces.
+
+    Usage:
+    crc = CrcXmodem(header)
+    crc.update(payload)
+    crc.digest()
+    '''
+
+    __slots__ = ('value',)
+
+    def __init__(self, data=b'', crc=0):
+        self.value = crc_hqx(data, crc)
+
+    @staticmethod
+    def calc(data):
+        '''Return the CRC of data (int).'''
+        return crc_hqx(data, 0)
+
+    def update(self, data):
+        '''Add data to the CRC and return self.'''
+        self.value = crc_hqx(data, self.value)
+        return self
+
+    def copy(self):
+        return CrcXmodem(crc=self.value)
+
+    def digest(self):
+        '''Return the CRC as two bytes, MSB first.'''
+        return self.value.to_bytes(2, 'big')
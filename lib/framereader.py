@@ -0,0 +1,142 @@
+# framereader.py, buffered reading of terminated frames from a visa resource
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+import logging
+import time
+
+FrameStats = collections.namedtuple('FrameStats', 'visa_calls duration_us')
+
+class FrameReader():
+    '''
+    Read frames ending in a terminator byte from a visa resource.
+
+    Instead of one read_bytes(1) per byte, the reader asks for as many bytes
+    as are known to be needed or available and splits the result on the
+    terminator. Bytes received after a terminator are kept for the next
+    frame.
+    '''
+
+    def __init__(self, resource, terminator=b'\n', min_frame=1):
+        '''
+        Input:
+            resource: visa resource supporting write_raw and read_bytes
+            terminator (bytes): end of frame marker
+            min_frame (int): minimum length of a frame, including the
+                terminator. This many bytes are requested in one call.
+        '''
+        self._resource = resource
+        self._terminator = terminator
+        self._min_frame = max(1, min_frame)
+        self._buffer = bytearray()
+        self._calls = 0
+
+        self.last_stats = FrameStats(0, 0.0)
+        self.total_calls = 0
+        self.total_frames = 0
+
+    def clear(self):
+        '''Discard any buffered bytes.'''
+        self._buffer.clear()
+
+    def flush(self):
+        '''
+        Discard buffered bytes and the bytes waiting at the resource, e.g.
+        answers arriving late after a timeout.
+        '''
+        self._buffer.clear()
+        try:
+            waiting = self._resource.bytes_in_buffer
+            if waiting > 0:
+                self._resource.read_bytes(waiting)
+        except Exception as e:
+            logging.debug('Flushing resource failed: %s', e)
+
+    def _available(self):
+        self._calls += 1
+        try:
+            return self._resource.bytes_in_buffer
+        except Exception:
+            return 1
+
+    def write(self, data):
+        '''Write raw data to the resource.'''
+        self._calls += 1
+        self._resource.write_raw(data)
+
+    def read_frame(self):
+        '''
+        Return the next frame, including its terminator.
+        '''
+        buf = self._buffer
+        try:
+            while True:
+                end = buf.find(self._terminator)
+                if end >= 0:
+                    break
+                missing = self._min_frame - len(buf)
+                if missing <= 0:
+                    missing = max(1, self._available())
+                buf += self._resource.read_bytes(missing)
+                self._calls += 1
+        except Exception:
+            buf.clear()
+            raise
+
+        end += len(self._terminator)
+        frame = bytes(buf[:end])
+        del buf[:end]
+        return frame
+
+    def query(self, data):
+        '''
+        Write data and return the answer frame. The number of visa calls
+        and the time spent are stored in last_stats.
+        '''
+        self._calls = 0
+        start = time.perf_counter()
+        try:
+            self.write(data)
+            return self.read_frame()
+        finally:
+            self._record(start)
+
+    def exchange(self, data, count):
+        '''
+        Write data holding several frames back to back and read 'count'
+        answer frames. If reading fails, the frames read so far are
+        returned. Statistics cover the whole exchange.
+        '''
+        self._calls = 0
+        start = time.perf_counter()
+        frames = []
+        try:
+            self.write(data)
+            while len(frames) < count:
+                frames.append(self.read_frame())
+        except Exception as e:
+            logging.warning('Reading frame %d of %d failed: %s',
+                len(frames) + 1, count, e)
+        self._record(start, len(frames))
+        return frames
+
+    def _record(self, start, frames=1):
+        duration = (time.perf_counter() - start) * 1e6
+        self.last_stats = FrameStats(self._calls, duration)
+        self.total_calls += self._calls
+        self.total_frames += frames
+        logging.debug('%d frame(s) took %d visa calls, %.0f us', frames,
+            self._calls, duration)
@@ -0,0 +1,69 @@
+# powermeter.py, power meter interface for laser calibration
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import numpy as np
+
+class PowerMeter():
+    '''
+    Power meter as used by SuperK_2014.acquire_calibration. Wrap a real
+    meter by overriding read_power and, if the meter corrects for its
+    wavelength dependent responsivity, set_wavelength.
+    '''
+
+    def set_wavelength(self, wavel):
+        '''Set the correction wavelength (nm) of the meter.'''
+        pass
+
+    def read_power(self):
+        '''Return the measured power in W.'''
+        raise NotImplementedError('read_power not implemented')
+
+class SimulatedPowerMeter(PowerMeter):
+    '''
+    Stand-in for a power meter in front of a laser, for offline runs.
+    The power is model(wavelength, relative power) plus a powermeter
+    offset and gaussian noise, the laser state is read from the laser's
+    last set power and the wavelength given to set_wavelength.
+    '''
+
+    def __init__(self, laser, model=None, offset=3e-8, noise=2e-10, seed=None):
+        '''
+        Input:
+            laser: instrument with a 'power' parameter (%)
+            model: function (wavelength in nm, relative power in %) -> W,
+                defaults to a smooth supercontinuum-like spectrum
+            offset, noise (float): powermeter offset and noise in W
+        '''
+        self._laser = laser
+        self._model = model if model is not None else self._default_model
+        self._offset = offset
+        self._noise = noise
+        self._rng = np.random.default_rng(seed)
+        self._wavel = None
+
+    @staticmethod
+    def _default_model(wavel, relative_power):
+        return 2e-3 * (relative_power / 100.0) ** 1.4 * (1 + 0.3 * np.sin(wavel / 80.0))
+
+    def set_wavelength(self, wavel):
+        self._wavel = wavel
+
+    def read_power(self):
+        wavel = self._wavel
+        if wavel is None:
+            wavel = self._laser.get_wavelength(query=False)
+        power = self._model(wavel, self._laser.get_power(query=False))
+        return float(power + self._offset + self._rng.normal(0, self._noise))
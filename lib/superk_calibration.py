@@ -0,0 +1,434 @@
+# superk_calibration.py, parsed-once SuperK power calibration data
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Calibration files are tab separated text with one line per measurement:
+
+    wavelength (nm) <tab> relative power (%) <tab> measured power (W)
+
+Lines starting with '#' and lines of 5 characters or less are skipped.
+The file holds one block of lines per relative power step, every block
+covering the same wavelengths.
+'''
+
+import logging
+import os
+import tempfile
+import threading
+import numpy as np
+
+class CalibrationData():
+    '''
+    Calibration grid of one file.
+
+    wavelengths: sorted unique wavelengths, shape (n_wavelengths,)
+    relative_power: relative power (%), shape (n_powers, n_wavelengths)
+    power: measured power (W), shape (n_powers, n_wavelengths)
+    '''
+
+    def __init__(self, wavelengths, relative_power, power):
+        self.wavelengths = wavelengths
+        self.relative_power = relative_power
+        self.power = power
+        self.min_power = power.min() if power.size else 0.0
+
+    def at_wavelength(self, wavel):
+        '''
+        Interpolate every power step linearly in wavelength, clamping
+        outside the calibrated range (as np.interp does).
+
+        Output: (relative power, power), both of shape (n_powers,)
+        '''
+        wl = self.wavelengths
+        if len(wl) == 1:
+            return self.relative_power[:, 0], self.power[:, 0]
+        i = min(max(int(np.searchsorted(wl, wavel, side='right')), 1), len(wl) - 1)
+        t = min(max((wavel - wl[i - 1]) / (wl[i] - wl[i - 1]), 0.0), 1.0)
+        rel = (1 - t) * self.relative_power[:, i - 1] + t * self.relative_power[:, i]
+        power = (1 - t) * self.power[:, i - 1] + t * self.power[:, i]
+        return rel, power
+
+    def curves_at(self, wavels):
+        '''
+        Vectorized at_wavelength for an array of wavelengths.
+
+        Output: (relative power, power), both of shape
+            (len(wavels), n_powers)
+        '''
+        wavels = np.asarray(wavels, dtype=float).ravel()
+        wl = self.wavelengths
+        if len(wl) == 1:
+            shape = (len(wavels), self.power.shape[0])
+            return (np.broadcast_to(self.relative_power[:, 0], shape),
+                np.broadcast_to(self.power[:, 0], shape))
+        i = np.clip(np.searchsorted(wl, wavels, side='right'), 1, len(wl) - 1)
+        t = np.clip((wavels - wl[i - 1]) / (wl[i] - wl[i - 1]), 0.0, 1.0)[:, None]
+        rel = (1 - t) * self.relative_power[:, i - 1].T + t * self.relative_power[:, i].T
+        power = (1 - t) * self.power[:, i - 1].T + t * self.power[:, i].T
+        return rel, power
+
+def invert_curve(target, x, fx):
+    '''
+    Find x where the curve fx(x) reaches target, by linear interpolation
+    between the two calibration points around it. Targets outside the
+    curve are clamped to its end points. A curve that is not increasing
+    is replaced by its running maximum, which resolves to the first
+    point where the target is reached. target may be an array.
+
+    Output: (x, monotonic), monotonic is False if fx decreases anywhere
+    '''
+    x = np.asarray(x, dtype=float)
+    fx = np.asarray(fx, dtype=float)
+    monotonic = not (np.diff(fx) < 0).any()
+    if not monotonic:
+        fx = np.maximum.accumulate(fx)
+    n = len(fx)
+    if n == 1:
+        return np.full(np.shape(target), x[0])[()], monotonic
+    i = np.clip(np.searchsorted(fx, target, side='left'), 1, n - 1)
+    d = fx[i] - fx[i - 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(d > 0, (target - fx[i - 1]) / d, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return (x[i - 1] + t * (x[i] - x[i - 1]))[()], monotonic
+
+def parse_calibration(filename):
+    '''
+    Read a calibration file into a CalibrationData object.
+    '''
+    rows = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if (line[0] != '#') and (len(line) > 5):
+                tmp = line.replace('\n', '').split('\t')
+                rows.append((float(tmp[0]), float(tmp[1]), float(tmp[2])))
+    data = np.array(rows, dtype=float).reshape(-1, 3)
+
+    wavelengths = np.unique(data[:, 0])
+    n_wavel = len(wavelengths)
+    n_power = len(data) // n_wavel if n_wavel else 0
+    data = data[:n_power * n_wavel]
+    relative_power = data[:, 1].reshape(n_power, n_wavel)
+    power = data[:, 2].reshape(n_power, n_wavel)
+    return CalibrationData(wavelengths, relative_power, power)
+
+def save_calibration(filename, data):
+    '''
+    Write CalibrationData to a calibration file and its calibration table
+    (<file>.lut.npy), replacing existing ones atomically, so drivers
+    reading or mapping them never see partly written files.
+
+    Output: the CalibrationTable, memory-mapped from the saved file
+    '''
+    def write(f):
+        f.write('# Wavelength (nm)\tRelative power (%)\tPower (W)\n')
+        for rel_row, power_row in zip(data.relative_power, data.power):
+            for wavel, rel, power in zip(data.wavelengths, rel_row, power_row):
+                f.write('%g\t%g\t%.6e\n' % (wavel, rel, power))
+    _check_wavelengths(data.wavelengths)
+    _write_atomic(filename, 'w', write)
+    st = os.stat(filename)
+    table = CalibrationTable.build(data, (st.st_mtime_ns, st.st_size))
+    table.save(filename + '.lut.npy')
+    store.invalidate(filename)
+    tables.invalidate(filename)
+    return CalibrationTable.load(filename + '.lut.npy')
+
+class CalibrationStore():
+    '''
+    Parsed calibration files, reloaded when a file's modification time
+    or size changes.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        '''
+        Return the CalibrationData of a file. Raises IOError if the file
+        does not exist.
+        '''
+        key = os.path.abspath(filename)
+        st = os.stat(key)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+        data = parse_calibration(key)
+        with self._lock:
+            self._entries[key] = (stamp, data)
+        return data
+
+    def invalidate(self, filename=None):
+        '''Drop one file, or all files, from the store.'''
+        with self._lock:
+            if filename is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(filename), None)
+
+
+class CalibrationTable():
+    '''
+    Calibration resampled on regular grids, for bilinear lookups:
+
+    forward: power (W) at (wavelength, relative power)
+    inverse: relative power (%) needed at (wavelength, normalized power),
+        the power normalized to the calibrated range at that wavelength
+
+    plus the power range and monotonicity of the calibration curve at
+    every grid wavelength. Tables are stored as a flat float64 .npy file
+    (TABLE_HEADER values followed by the blocks above) so they can be
+    memory-mapped, and are shared between processes through the page
+    cache.
+    '''
+
+    VERSION = 2
+    # source_mtime is split in s and ns, a float64 cannot hold st_mtime_ns
+    TABLE_HEADER = ('version', 'n_wavel', 'n_rel', 'n_power', 'wavel0',
+        'wavel_step', 'rel0', 'rel_step', 'min_power', 'source_mtime_s',
+        'source_mtime_ns', 'source_size')
+    # Upper limit of the wavelength grid, every grid wavelength takes
+    # (n_rel + n_power) float64 values
+    MAX_WAVELENGTHS = 1001
+
+    def __init__(self, array):
+        h = dict(zip(self.TABLE_HEADER, array[:len(self.TABLE_HEADER)]))
+        if int(h['version']) != self.VERSION:
+            raise ValueError('Unsupported calibration table version')
+        n_wl, n_rel, n_pow = int(h['n_wavel']), int(h['n_rel']), int(h['n_power'])
+        self.wavel0, self.wavel_step = h['wavel0'], h['wavel_step']
+        self.rel0, self.rel_step = h['rel0'], h['rel_step']
+        self.min_power = h['min_power']
+        self.source = (int(h['source_mtime_s']) * 10**9 + int(h['source_mtime_ns']),
+            int(h['source_size']))
+        self.array = array
+
+        pos = len(self.TABLE_HEADER)
+        blocks = []
+        for size in (n_wl * n_rel, n_wl * n_pow, n_wl, n_wl, n_wl):
+            blocks.append(array[pos:pos + size])
+            pos += size
+        if pos != len(array):
+            raise ValueError('Calibration table has wrong size')
+        self.forward = blocks[0].reshape(n_wl, n_rel)
+        self.inverse = blocks[1].reshape(n_wl, n_pow)
+        self.power_min, self.power_max, self.monotonic = blocks[2:]
+
+    @classmethod
+    def build(cls, data, source=(0, 0), wavel_step=None, n_rel=1001, n_power=4096):
+        '''
+        Resample CalibrationData on regular grids. Raises ValueError if
+        the wavelengths of data do not increase.
+
+        Input:
+            data: CalibrationData
+            source: (mtime in ns, size) of the calibration file
+            wavel_step: wavelength grid step (nm), defaults to the
+                smallest spacing in the calibration file; enlarged if
+                the grid would exceed MAX_WAVELENGTHS points
+            n_rel, n_power: number of relative power and normalized
+                power points
+        '''
+        wl = data.wavelengths
+        _check_wavelengths(wl)
+        span = wl[-1] - wl[0]
+        if wavel_step is None:
+            wavel_step = np.diff(wl).min() if len(wl) > 1 else 1.0
+        if not wavel_step > 0:
+            raise ValueError('Wavelength step must be > 0, not %r' % wavel_step)
+        wavel_step = max(wavel_step, span / (cls.MAX_WAVELENGTHS - 1))
+        n_wl = int(round(span / wavel_step)) + 1
+        grid_wl = wl[0] + wavel_step * np.arange(n_wl)
+        rel_lo, rel_hi = data.relative_power.min(), data.relative_power.max()
+        rel_axis = np.linspace(rel_lo, rel_hi, n_rel)
+        norm_axis = np.linspace(0.0, 1.0, n_power)
+
+        rel, curves = data.curves_at(grid_wl)
+        forward = np.empty((n_wl, n_rel))
+        inverse = np.empty((n_wl, n_power))
+        monotonic = np.empty(n_wl)
+        power_min = curves.min(axis=1)
+        power_max = curves.max(axis=1)
+        for i in range(n_wl):
+            forward[i] = np.interp(rel_axis, rel[i], curves[i])
+            power_axis = power_min[i] + norm_axis * (power_max[i] - power_min[i])
+            inverse[i], monotonic[i] = invert_curve(power_axis, rel[i], curves[i])
+
+        header = [cls.VERSION, n_wl, n_rel, n_power, wl[0], wavel_step,
+            rel_lo, _step(rel_axis), data.min_power, source[0] // 10**9,
+            source[0] % 10**9, source[1]]
+        return cls(np.concatenate((np.array(header, dtype=float),
+            forward.ravel(), inverse.ravel(), power_min, power_max,
+            monotonic)))
+
+    def save(self, filename):
+        '''
+        Save the table. The file is replaced atomically, so processes
+        that have the old table mapped keep reading it and no process
+        maps a partly written table.
+        '''
+        _write_atomic(filename, 'wb', lambda f: np.save(f, np.asarray(self.array)))
+
+    @classmethod
+    def load(cls, filename):
+        '''Memory-map a table saved with save().'''
+        return cls(np.load(filename, mmap_mode='r'))
+
+    def _wavel_index(self, wavel):
+        n = len(self.monotonic)
+        f = np.clip((np.asarray(wavel, dtype=float) - self.wavel0) / self.wavel_step, 0, n - 1)
+        i = np.minimum(f.astype(int), max(n - 2, 0))
+        return i, np.minimum(i + 1, n - 1), f - i
+
+    def power_at(self, relative_power, wavel):
+        '''Power (W) delivered at relative_power (%) and wavel.'''
+        return _bilinear(self.forward, self._wavel_index(wavel),
+            relative_power, self.rel0, self.rel_step)
+
+    def relative_power_at(self, power, wavel):
+        '''Relative power (%) needed for power (W) at wavel.'''
+        index = self._wavel_index(wavel)
+        lo, hi = self._power_range(index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm = np.where(hi > lo, (power - lo) / (hi - lo), 0.0)
+        return _bilinear(self.inverse, index, norm, 0.0,
+            1.0 / max(self.inverse.shape[1] - 1, 1))
+
+    def power_range(self, wavel):
+        '''Calibrated (min, max) power (W) at wavel.'''
+        lo, hi = self._power_range(self._wavel_index(wavel))
+        return lo[()], hi[()]
+
+    def _power_range(self, wavel_index):
+        i, i1, t = wavel_index
+        lo = (1 - t) * self.power_min[i] + t * self.power_min[i1]
+        hi = (1 - t) * self.power_max[i] + t * self.power_max[i1]
+        return lo, hi
+
+    def relative_range(self):
+        return self.rel0, self.rel0 + self.rel_step * (self.forward.shape[1] - 1)
+
+    def is_monotonic(self, wavel):
+        '''True where the calibration curve at wavel is monotonic.'''
+        i, i1, t = self._wavel_index(wavel)
+        return ((self.monotonic[i] > 0) & (self.monotonic[i1] > 0))[()]
+
+def _write_atomic(filename, mode, write):
+    '''
+    Call write(f) with a temporary file in the directory of filename, then
+    move it over filename. On failure filename is left as it was.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        # mkstemp makes the file private, keep the permissions of the
+        # file replaced so other users can still read it
+        try:
+            permissions = os.stat(filename).st_mode & 0o777
+        except OSError:
+            permissions = 0o644
+        os.chmod(tmp, permissions)
+        os.replace(tmp, filename)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def _check_wavelengths(wavelengths):
+    if len(wavelengths) == 0:
+        raise ValueError('Calibration has no wavelengths')
+    if (np.diff(wavelengths) <= 0).any():
+        raise ValueError('Calibration wavelengths must increase')
+
+def _step(axis):
+    return axis[1] - axis[0] if len(axis) > 1 else 1.0
+
+def _bilinear(grid, wavel_index, x, x0, x_step):
+    i, i1, t = wavel_index
+    n = grid.shape[1]
+    f = np.clip((np.asarray(x, dtype=float) - x0) / x_step, 0, n - 1)
+    j = np.minimum(f.astype(int), max(n - 2, 0))
+    j1 = np.minimum(j + 1, n - 1)
+    u = f - j
+    low = (1 - u) * grid[i, j] + u * grid[i, j1]
+    high = (1 - u) * grid[i1, j] + u * grid[i1, j1]
+    return ((1 - t) * low + t * high)[()]
+
+class TableStore():
+    '''
+    Calibration tables of calibration files. The table of a file is
+    kept next to it as <file>.lut.npy, memory-mapped when it matches the
+    file, and rebuilt and saved otherwise.
+    '''
+
+    def __init__(self, data_store):
+        self._data_store = data_store
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        '''
+        Return the CalibrationTable of a file. Raises IOError if the file
+        does not exist.
+        '''
+        key = os.path.abspath(filename)
+        st = os.stat(key)
+        source = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            table = self._entries.get(key)
+            if table is not None and table.source == source:
+                return table
+            table = self._load(key + '.lut.npy', source)
+            if table is None:
+                table = CalibrationTable.build(self._data_store.get(key), source)
+                try:
+                    table.save(key + '.lut.npy')
+                    table = CalibrationTable.load(key + '.lut.npy')
+                except (IOError, OSError) as e:
+                    logging.warning('Could not save calibration table of %s: %s', key, e)
+            self._entries[key] = table
+            return table
+
+    def _load(self, filename, source):
+        try:
+            table = CalibrationTable.load(filename)
+        except (IOError, OSError):
+            return None
+        except ValueError as e:
+            logging.warning('Ignoring calibration table %s: %s', filename, e)
+            return None
+        if table.source != source:
+            return None
+        return table
+
+    def invalidate(self, filename=None):
+        '''Drop one file, or all files, from the store.'''
+        with self._lock:
+            if filename is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(filename), None)
+
+# Shared by all drivers in the process
+store = CalibrationStore()
+tables = TableStore(store)
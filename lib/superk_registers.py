@@ -0,0 +1,78 @@
+# superk_registers.py, host side copy of SuperK module registers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+class RegisterShadow():
+    '''
+    Write-through copy of module registers.
+
+    Only registers listed at construction are shadowed; anything else
+    (streamed tables, index pointers, status bits the hardware changes on
+    its own) is always written. Values are the payload bytes as sent on
+    the bus (LSB first) and are only trusted after an acknowledged write
+    or a datagram answer to a read.
+    '''
+
+    def __init__(self, registers):
+        '''
+        Input:
+            registers (dict): module address (int) -> iterable of register
+                addresses (int) to shadow
+        '''
+        self._registers = dict((dest, frozenset(regs))
+            for dest, regs in registers.items())
+        self._values = {}
+
+        # Number of writes sent to / skipped for shadowed registers
+        self.sent = 0
+        self.skipped = 0
+
+    def covers(self, dest, register):
+        '''Return whether register 'register' of module 'dest' is shadowed.'''
+        return register in self._registers.get(dest, ())
+
+    def get(self, dest, register):
+        '''Return the known payload of a register, or None.'''
+        return self._values.get((dest, register))
+
+    def registers(self):
+        '''Return all shadowed (dest, register) pairs.'''
+        return [(dest, reg) for dest in sorted(self._registers)
+            for reg in sorted(self._registers[dest])]
+
+    def is_current(self, dest, register, data):
+        '''Return whether the register is known to hold 'data'.'''
+        return self._values.get((dest, register)) == data
+
+    def update(self, dest, register, data):
+        '''Record the payload of a register, if it is shadowed.'''
+        if register in self._registers.get(dest, ()):
+            self._values[(dest, register)] = bytes(data)
+
+    def discard(self, dest, register):
+        '''Forget the payload of a single register.'''
+        self._values.pop((dest, register), None)
+
+    def invalidate(self, dest=None):
+        '''Forget all payloads, or those of module 'dest'.'''
+        if dest is None:
+            self._values.clear()
+        else:
+            for key in [k for k in self._values if k[0] == dest]:
+                del self._values[key]
+
+    def reset_counters(self):
+        self.sent = 0
+        self.skipped = 0
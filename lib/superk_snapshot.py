@@ -0,0 +1,138 @@
+# superk_snapshot.py, binary snapshots of SuperK module registers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+File format (little endian):
+
+    header:  magic 'SKRS', version (uint16), timestamp (float64),
+             number of registers (uint32), number of absent registers (uint32)
+    then per register:  module (uint8), register (uint8), length (uint16),
+                        payload as sent on the bus (LSB first)
+    then per absent register:  module (uint8), register (uint8)
+'''
+
+import struct
+import time
+
+MAGIC = b'SKRS'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHdII')
+_ENTRY = struct.Struct('<BBH')
+_ABSENT = struct.Struct('<BB')
+
+class SnapshotError(Exception):
+    '''Exception raised for files that are not valid snapshots.'''
+
+class RegisterSnapshot():
+    '''
+    Register contents of one or more modules.
+
+    registers: dict (module, register) -> payload (bytes, LSB first)
+    absent: set of (module, register) the module reported not to have
+    '''
+
+    def __init__(self, registers=None, absent=None, timestamp=None):
+        self.registers = dict(registers or {})
+        self.absent = set(absent or ())
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+
+    def __len__(self):
+        return len(self.registers)
+
+    def __contains__(self, key):
+        return key in self.registers
+
+    def __getitem__(self, key):
+        return self.registers[key]
+
+    def get(self, dest, register):
+        return self.registers.get((dest, register))
+
+    def value(self, dest, register):
+        '''Return the payload of a register as an unsigned int, or None.'''
+        data = self.registers.get((dest, register))
+        if data is None:
+            return None
+        return int.from_bytes(data, 'little')
+
+    def to_bytes(self):
+        parts = [_HEADER.pack(MAGIC, VERSION, self.timestamp,
+            len(self.registers), len(self.absent))]
+        for (dest, register), data in sorted(self.registers.items()):
+            parts.append(_ENTRY.pack(dest, register, len(data)))
+            parts.append(data)
+        for dest, register in sorted(self.absent):
+            parts.append(_ABSENT.pack(dest, register))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        try:
+            magic, version, timestamp, n_reg, n_absent = \
+                _HEADER.unpack_from(buf, 0)
+        except struct.error:
+            raise SnapshotError('Snapshot too short')
+        if magic != MAGIC:
+            raise SnapshotError('Not a register snapshot')
+        if version > VERSION:
+            raise SnapshotError('Unsupported snapshot version %d' % version)
+
+        registers = {}
+        pos = _HEADER.size
+        try:
+            for i in range(n_reg):
+                dest, register, length = _ENTRY.unpack_from(buf, pos)
+                pos += _ENTRY.size
+                registers[(dest, register)] = bytes(buf[pos:pos + length])
+                pos += length
+            absent = []
+            for i in range(n_absent):
+                absent.append(_ABSENT.unpack_from(buf, pos))
+                pos += _ABSENT.size
+        except struct.error:
+            raise SnapshotError('Snapshot truncated')
+        return cls(registers, absent, timestamp)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+def diff(snapshot_a, snapshot_b):
+    '''
+    Compare two snapshots.
+
+    Output: list of (module, register, payload in a, payload in b) for
+        every register whose payload differs, sorted by module and
+        register. The payload is None if the register is missing from
+        that snapshot.
+    '''
+    a = snapshot_a.registers
+    b = snapshot_b.registers
+    result = []
+    for key in sorted(set(a) | set(b)):
+        data_a = a.get(key)
+        data_b = b.get(key)
+        if data_a != data_b:
+            result.append(key + (data_a, data_b))
+    return result
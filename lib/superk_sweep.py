@@ -0,0 +1,77 @@
+# superk_sweep.py, pre-encoded SuperK sweep plans
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+from . import superk_telegram as telegram
+
+SweepPoint = collections.namedtuple('SweepPoint',
+    'output wavelength power power_density')
+
+class SweepPlan():
+    '''
+    Register writes of every point of a sweep, encoded to telegrams in
+    advance.
+
+    A point only writes the registers that differ from the previous
+    point; the first point and the first point after an output change
+    write all of them. The writes of point i are in chunks[i], a list of
+    (frames, requests): frames are the concatenated telegrams and
+    requests the (dest, type, register, data) tuples they encode, at most
+    'depth' telegrams per chunk.
+    '''
+
+    def __init__(self, host, depth=16):
+        self._host = host
+        self._depth = depth
+        self.points = []
+        self.chunks = []
+        self._registers = {}
+        self._output = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, point, writes):
+        '''
+        Add a point and encode its writes.
+
+        Input:
+            point: SweepPoint
+            writes: list of (dest, register, data) for the point
+        '''
+        if point.output != self._output:
+            self._registers = {}
+            self._output = point.output
+        changed = [w for w in writes if self._registers.get(w[:2]) != w[2]]
+        for dest, register, data in writes:
+            self._registers[(dest, register)] = data
+        self.points.append(point)
+        self.chunks.append(self._encode(changed))
+
+    def _encode(self, writes):
+        chunks = []
+        for start in range(0, len(writes), self._depth):
+            requests = [(dest, telegram.TYPE_WRITE, register, data)
+                        for dest, register, data in writes[start:start + self._depth]]
+            frames = b''.join(telegram.encode(dest, self._host, type, register, data)
+                              for dest, type, register, data in requests)
+            chunks.append((frames, requests))
+        return chunks
+
+    def telegram_count(self):
+        '''Return the number of telegrams of the whole sweep.'''
+        return sum(len(requests) for chunks in self.chunks
+                   for frames, requests in chunks)
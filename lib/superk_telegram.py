@@ -0,0 +1,141 @@
+# superk_telegram.py, byte-level telegram codec for the NKT SuperK interbus
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+A telegram on the wire looks like
+
+    SOT | dest | source | type | register | data (LSB first) | CRC (MSB first) | EOT
+
+where every byte between SOT and EOT that equals SOT, EOT or SOE is sent
+as SOE followed by the byte plus 64. The CRC (CRC-CCITT, XModem) is
+calculated over the unescaped bytes from dest up to the end of the data.
+'''
+
+import collections
+import re
+from .crc import crc_xmodem
+
+SOT = 0x0D              # Start of telegram - \r
+EOT = 0x0A              # End of telegram - \n
+SOE = 0x5E              # Start of substitution word
+ESCAPE_OFFSET = 64      # Value to add for substitution
+
+# Telegram types
+TYPE_NACK = 0x00
+TYPE_CRC_ERROR = 0x01
+TYPE_BUSY = 0x02
+TYPE_ACK = 0x03
+TYPE_READ = 0x04
+TYPE_WRITE = 0x05
+TYPE_DATAGRAM = 0x08
+
+_RESERVED = (SOT, EOT, SOE)
+
+def _build_escape_table():
+    table = {}
+    for i in _RESERVED:
+        table[bytes((i,))] = bytes((SOE, i + ESCAPE_OFFSET))
+    return table
+
+def _build_unescape_table():
+    table = {}
+    for i in range(256):
+        table[bytes((SOE, i))] = bytes(((i - ESCAPE_OFFSET) & 0xFF,))
+    return table
+
+_ESCAPE_TABLE = _build_escape_table()
+_UNESCAPE_TABLE = _build_unescape_table()
+_ESCAPE_RE = re.compile(b'[\\x0d\\x0a\\x5e]')
+_UNESCAPE_RE = re.compile(b'\\x5e.', re.DOTALL)
+
+class TelegramError(Exception):
+    '''Exception raised for telegrams that cannot be decoded.'''
+
+class Telegram(collections.namedtuple('Telegram',
+        'dest source type register data crc crc_ok')):
+    '''
+    Decoded telegram. 'data' holds the payload as sent on the wire
+    (LSB first), 'crc' the received CRC as an int.
+    '''
+
+    __slots__ = ()
+
+    @property
+    def value(self):
+        '''Payload as an unsigned little endian integer.'''
+        return int.from_bytes(self.data, 'little')
+
+    def hex(self):
+        '''
+        Return the telegram in the hex string layout send_command has
+        always returned: header, data MSB first, CRC.
+        '''
+        return '%02x%02x%02x%02x%s%04x' % (self.dest, self.source,
+            self.type, self.register, self.data[::-1].hex(), self.crc)
+
+# Telegram types a module answers a read or a write request with
+ANSWER_TYPES = {
+    TYPE_READ: (TYPE_DATAGRAM, TYPE_NACK, TYPE_CRC_ERROR, TYPE_BUSY),
+    TYPE_WRITE: (TYPE_ACK, TYPE_NACK, TYPE_CRC_ERROR, TYPE_BUSY),
+}
+
+def is_answer(reply, host, dest, type, register):
+    '''
+    Return whether a decoded telegram answers the request of the given
+    type to register of module dest, sent by host.
+    '''
+    return reply.dest == host and reply.source == dest and \
+        reply.register == register and \
+        reply.type in ANSWER_TYPES.get(type, (reply.type,))
+
+def escape(data):
+    '''Substitute the reserved bytes in data.'''
+    return _ESCAPE_RE.sub(lambda m: _ESCAPE_TABLE[m.group()], data)
+
+def unescape(data):
+    '''Undo the substitution of reserved bytes in data.'''
+    return _UNESCAPE_RE.sub(lambda m: _UNESCAPE_TABLE[m.group()], data)
+
+def encode(dest, source, type, register, data=b''):
+    '''
+    Build a complete telegram.
+
+    Input:
+        dest, source, type, register (int): header bytes
+        data (bytes): payload, LSB first
+    Output: framed telegram (bytes)
+    '''
+    header = bytes((dest, source, type, register))
+    crc = crc_xmodem(data, crc_xmodem(header))
+    return b'\r' + escape(header + data + crc.to_bytes(2, 'big')) + b'\n'
+
+def decode(frame):
+    '''
+    Decode a telegram received from the bus.
+
+    Input: frame (bytes), optionally including SOT and EOT
+    Output: Telegram
+    '''
+    start = frame.rfind(b'\r') + 1
+    end = frame.find(b'\n', start)
+    if end < 0:
+        end = len(frame)
+    body = unescape(frame[start:end])
+    if len(body) < 6:
+        raise TelegramError('Telegram too short: %r' % frame)
+    crc_ok = crc_xmodem(body) == 0
+    return Telegram(body[0], body[1], body[2], body[3], body[4:-2],
+        int.from_bytes(body[-2:], 'big'), crc_ok)